@@ -9,11 +9,21 @@ import csv
 import json
 import glob
 import multiprocessing
-import os
 import random
 import sys
 import time
-from typing import Any, Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+)
 
 import click
 
@@ -21,7 +31,21 @@ import requests
 from tqdm import tqdm  # type: ignore
 
 from ..populate import populate_cli
-from ..settings import GITHUB_TOKEN
+from . import client
+from . import manifest
+from .batches import (
+    DEFAULT_FORMAT,
+    FORMATS,
+    BatchWriter,
+    batch_path,
+    batch_start_id,
+    batch_summary,
+    iter_repositories,
+    list_batches,
+    rewrite_start_id,
+)
+from .sampling import sample_fixed_size
+from .tokens import TokenPool, TokenPoolExhausted, authorization_headers, load_tokens
 
 subcommand = "allrepos"
 
@@ -30,13 +54,25 @@ REMAINING_RATELIMIT_HEADER = "X-RateLimit-Remaining"
 
 
 def crawl(
-    start_id: int, max_id: int, interval: float, min_rate_limit: int
+    start_id: int,
+    max_id: int,
+    interval: float,
+    min_rate_limit: int,
+    pool: Optional[TokenPool] = None,
+    writer: Optional[BatchWriter] = None,
 ) -> Dict[str, Any]:
     """
     Crawls the /repositories endpoint of the GitHub API until it hits a page on which the maximum ID
     is greater than or equal to the given max_id parameter, at which point, it returns the results
     of the crawl as a Python dictionary.
 
+    If a batch writer is given, pages are streamed to it as they arrive instead of being collected
+    in the "data" list of the result.
+
+    The "complete" key of the result tells whether the crawl reached max_id (or the end of the
+    data). It is False if the crawl was interrupted by the rate limit or by an error, in which case
+    "max_id" is the last ID which was crawled successfully.
+
     Args:
     start_id
         Last ID seen when crawling the public repositories
@@ -46,8 +82,13 @@ def crawl(
         Number of seconds (fractional OK) for which to wait between API requests. This is to help
         with rate-limiting.
     min_rate_limit
-        If the X-RateLimit-Remaining header on any response is less than this number, stop crawling
-        and return right away.
+        If the X-RateLimit-Remaining header on a response is less than this number, the token used
+        for the request is parked until its rate limit is reset. Once every token in the pool is
+        parked, stop crawling and return right away.
+    pool
+        Tokens to make requests with (default: tokens configured in the environment)
+    writer
+        Batch file to which repositories should be written
     """
     result = {
         "start_id": start_id,
@@ -60,34 +101,59 @@ def crawl(
         "Accept": "application/vnd.github.v3+json",
         "User-Agent": "simiotics mirror",
     }
-    github_token = GITHUB_TOKEN
-    if github_token is not None and github_token != "":
-        headers["Authorization"] = f"token {github_token}"
+    if pool is None:
+        pool = TokenPool(load_tokens(), min_rate_limit)
+    if writer is not None:
+        writer.write_header(result)
 
+    complete = False
     since = start_id
-    curr_rate_limit = min_rate_limit + 10
-    while since is not None and since < max_id and curr_rate_limit > min_rate_limit:
+    while since is not None and since < max_id:
+        try:
+            token = pool.acquire(block=False)
+        except TokenPoolExhausted:
+            break
         time.sleep(interval)
-        r = requests.get(REPOSITORIES_URL, params={"since": since}, headers=headers)
-        response_body = r.json()
+        try:
+            try:
+                r = client.get(
+                    REPOSITORIES_URL,
+                    params={"since": since},
+                    headers={**headers, **authorization_headers(token)},
+                )
+            except requests.RequestException:
+                pool.release(token)
+                raise
+            pool.update(token, r.headers)
+            if (
+                r.status_code in (403, 429)
+                and r.headers.get(REMAINING_RATELIMIT_HEADER) == "0"
+            ):
+                # Token is parked now - retry the page with the next one
+                continue
+            r.raise_for_status()
+            response_body = r.json()
+        except (requests.RequestException, ValueError) as err:
+            print(f"Crawl stopped after ID {since}: {repr(err)}", file=sys.stderr)
+            break
         if not response_body:
+            complete = True
             break
 
-        result["data"].extend(response_body)  # type: ignore
+        if writer is not None:
+            writer.write(response_body)
+        else:
+            result["data"].extend(response_body)  # type: ignore
         since = response_body[-1].get("id")
 
-        curr_rate_limit_raw = r.headers.get(REMAINING_RATELIMIT_HEADER)
-        try:
-            curr_rate_limit = -1
-            if curr_rate_limit_raw is not None:
-                curr_rate_limit = int(curr_rate_limit_raw)
-        except:
-            break
+    if since is not None and since >= max_id:
+        complete = True
 
     result["max_id"] = since
+    result["complete"] = complete
     result["end"] = int(time.time())
     result["command"] = "crawl"
-    result["ending_rate_limit"] = curr_rate_limit
+    result["ending_rate_limit"] = pool.remaining()
 
     return result
 
@@ -138,6 +204,20 @@ def crawl(
     "-d",
     help="Path to directory in which crawl results should be written",
 )
+@click.option(
+    "--format",
+    "-f",
+    type=click.Choice(list(FORMATS.keys())),
+    default=DEFAULT_FORMAT,
+    help="Format of the batch files: a JSON object per batch, or (compressed) JSON lines streamed as pages arrive",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=int,
+    default=1,
+    help="Number of disjoint ID ranges to crawl concurrently",
+)
 def crawl_handler(
     start_id: int,
     max_id: int,
@@ -145,12 +225,15 @@ def crawl_handler(
     min_rate_limit: int,
     batch_size: int,
     crawldir: str,
+    workers: int,
+    format: str,
 ) -> None:
     """
     Processes arguments as parsed from the command line and uses them to run a crawl of the GitHub
     /repositories endpoint.
 
-    Results are stored as JSON file in the output directory specified in the arguments.
+    Results are stored as JSON file in the output directory specified in the arguments. With more
+    than one worker, the ID range is split into disjoint sub-ranges which are crawled concurrently.
 
     Args:
     args
@@ -159,27 +242,188 @@ def crawl_handler(
 
     Returns: None
     """
+    pool = TokenPool(load_tokens(), min_rate_limit)
+    if not manifest.has_manifest(crawldir):
+        manifest.reindex(crawldir)
     next_id = nextid(crawldir)
     current_max = max(start_id, next_id)
+    if workers > 1:
+        parallel_crawl(
+            current_max,
+            max_id,
+            interval,
+            min_rate_limit,
+            batch_size,
+            crawldir,
+            workers,
+            pool,
+            format,
+        )
+        return
+
     while current_max < max_id:
+        writer = BatchWriter(crawldir, current_max, format)
         result = crawl(
             current_max,
             min(current_max + batch_size, max_id),
             interval,
             min_rate_limit,
+            pool,
+            writer,
         )
-        outfile = os.path.join(crawldir, f"{current_max}.json")
-        with open(outfile, "w") as ofp:
-            json.dump(result, ofp)
+        writer.close(result)
+        manifest.record_batch(crawldir, writer.path, writer.summary())
 
-        if len(result["data"]) == 0:
+        if writer.count == 0 or writer.last_id is None:
             break
-        current_max = result["data"][-1]["id"]
+        current_max = writer.last_id
 
-        if result["ending_rate_limit"] < min_rate_limit:
+        if pool.exhausted():
             break
 
 
+def crawl_range(
+    start_id: int,
+    max_id: int,
+    interval: float,
+    min_rate_limit: int,
+    batch_size: int,
+    crawldir: str,
+    pool: TokenPool,
+    format: str = DEFAULT_FORMAT,
+) -> Tuple[List[int], int, bool]:
+    """
+    Crawls the IDs in the range (start_id, max_id] into batch files in the given crawl directory.
+    Repositories with IDs greater than max_id are dropped, so that neighbouring ranges crawled by
+    other workers do not overlap. Empty batches are not written.
+
+    Args:
+    start_id
+        Last ID seen before the range - the crawl starts from its successor
+    max_id
+        Last ID that belongs to the range
+    interval
+        Number of seconds (fractional OK) for which to wait between API requests
+    min_rate_limit
+        Minimum remaining rate limit on API under which the crawl is interrupted
+    batch_size
+        Number of IDs each batch file should (roughly) span
+    crawldir
+        Path to directory in which crawl results should be written
+    pool
+        Tokens to make requests with
+    format
+        Format of the batch files
+
+    Returns: Triple of (start IDs of the batch files written, last repository ID seen, whether the
+    crawl covered the whole range). If the crawl was interrupted by the rate limit or by an error,
+    the range is incomplete and the last ID is the last one which was crawled successfully.
+    """
+    written: List[int] = []
+    current_max = start_id
+    while current_max < max_id:
+        writer = BatchWriter(crawldir, current_max, format, max_repository_id=max_id)
+        result = crawl(
+            current_max,
+            min(current_max + batch_size, max_id),
+            interval,
+            min_rate_limit,
+            pool,
+            writer,
+        )
+        writer.close(result, keep_empty=False)
+        if writer.count and writer.last_id is not None:
+            manifest.record_batch(crawldir, writer.path, writer.summary())
+            written.append(current_max)
+            current_max = writer.last_id
+
+        if not result["complete"]:
+            return written, current_max, False
+        if writer.count == 0 or writer.last_id is None:
+            return written, current_max, True
+
+        if pool.exhausted():
+            return written, current_max, False
+
+    return written, current_max, True
+
+
+def stitch_batch(
+    crawldir: str, old_start_id: int, new_start_id: int, format: str = DEFAULT_FORMAT
+) -> None:
+    """
+    Renames the batch file starting at old_start_id so that it starts at new_start_id instead.
+
+    This is only correct if there are no repositories with IDs in (new_start_id, old_start_id] -
+    in that case, a crawl from new_start_id would have produced exactly the same batch.
+    """
+    old_path = batch_path(crawldir, old_start_id, format)
+    new_path = rewrite_start_id(old_path, new_start_id)
+    manifest.forget_batch(crawldir, old_path)
+    manifest.record_batch(crawldir, new_path)
+
+
+def parallel_crawl(
+    start_id: int,
+    max_id: int,
+    interval: float,
+    min_rate_limit: int,
+    batch_size: int,
+    crawldir: str,
+    workers: int,
+    pool: TokenPool,
+    format: str = DEFAULT_FORMAT,
+) -> None:
+    """
+    Splits (start_id, max_id] into disjoint sub-ranges and crawls them concurrently, one thread per
+    sub-range.
+
+    Each sub-range is written as regular <start_id> batch files. Once all workers are done,
+    the first batch of every sub-range is renamed to start at the last ID seen by the preceding
+    sub-range so that the directory looks exactly like the output of a sequential crawl (and
+    nextid, validate and sync work on it unchanged). Sub-ranges which were interrupted by the rate
+    limit or by an error are reported on stderr and the sub-range after them is not renamed, so
+    that the IDs which were not crawled show up as holes in the output of validate.
+    """
+    if start_id >= max_id:
+        return
+    step = max(int((max_id - start_id) / workers) + 1, 1)
+    boundaries = list(range(start_id, max_id, step)) + [max_id]
+    ranges = list(zip(boundaries[:-1], boundaries[1:]))
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(
+                crawl_range,
+                range_start,
+                range_end,
+                interval,
+                min_rate_limit,
+                batch_size,
+                crawldir,
+                pool,
+                format,
+            )
+            for range_start, range_end in ranges
+        ]
+        outcomes = [future.result() for future in futures]
+
+    previous_last_id: Optional[int] = start_id
+    for (range_start, range_end), outcome in zip(ranges, outcomes):
+        written, last_id, complete = outcome
+        if previous_last_id is not None and written and written[0] == range_start:
+            if previous_last_id != range_start:
+                stitch_batch(crawldir, range_start, previous_last_id, format)
+        if not complete:
+            print(
+                f"Range ({last_id}, {range_end}] was not crawled - crawl was interrupted",
+                file=sys.stderr,
+            )
+            previous_last_id = None
+        elif written:
+            previous_last_id = last_id
+
+
 def ordered_crawl(crawldir: str) -> List[Tuple[str, int]]:
     """
     Returns the contents of the given crawl directory ordered by their start id (in ascending order)
@@ -192,18 +436,21 @@ def ordered_crawl(crawldir: str) -> List[Tuple[str, int]]:
     step they represent. Returns the start_id of each result file as the second coordinate of each
     tuple in the return list.
     """
-    result_files = glob.glob(os.path.join(crawldir, "*.json"))
+    if manifest.has_manifest(crawldir):
+        return [
+            (entry["path"], entry["start_id"]) for entry in manifest.entries(crawldir)
+        ]
+
+    result_files = list_batches(crawldir)
     if not result_files:
         return []
-    indexed_result_files = [
-        (rfile, int(os.path.basename(rfile).split(".")[0])) for rfile in result_files
-    ]
+    indexed_result_files = [(rfile, batch_start_id(rfile)) for rfile in result_files]
     return sorted(indexed_result_files, key=lambda p: p[1])
 
 
 def nextid(crawldir: str) -> int:
     """
-    Given a directory containing only JSON files produced by an allrepos crawl, this function
+    Given a directory containing only batch files produced by an allrepos crawl, this function
     returns the maximum ID seen in that crawl.
 
     Args:
@@ -212,18 +459,23 @@ def nextid(crawldir: str) -> int:
 
     Returns: Maximum ID over all repositories seen in the crawl
     """
-    result_files = glob.glob(os.path.join(crawldir, "*.json"))
+    if manifest.has_manifest(crawldir):
+        entry = manifest.last_entry(crawldir)
+        if entry is None:
+            return 0
+        if entry["count"] == 0:
+            return entry["start_id"]
+        return entry["last_id"]
+
+    result_files = list_batches(crawldir)
     if not result_files:
         return 0
-    indexed_result_files = [
-        (rfile, int(os.path.basename(rfile).split(".")[0])) for rfile in result_files
-    ]
+    indexed_result_files = [(rfile, batch_start_id(rfile)) for rfile in result_files]
     last_file, index = max(indexed_result_files, key=lambda p: p[1])
-    with open(last_file, "r") as ifp:
-        result = json.load(ifp)
-    if len(result["data"]) == 0:
+    summary = batch_summary(last_file)
+    if summary["count"] == 0:
         return index
-    return result["data"][-1]["id"]
+    return summary["last_id"]
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
@@ -264,19 +516,37 @@ def validate(result_range: List[Tuple[str, int]]) -> List[Tuple[int, int]]:
 
     for i, pair in enumerate(result_range[:-1]):
         result_file, this_id = pair
-        with open(result_file, "r") as ifp:
-            result = json.load(ifp)
+        summary = batch_summary(result_file)
         _, next_id = result_range[i + 1]
-        if not result.get("data"):
+        if not summary["count"]:
             missing_ranges.append((this_id, next_id))
             continue
-        max_id = result["data"][-1].get("id", -1)
+        max_id = summary["last_id"]
         if max_id != next_id:
             missing_ranges.append((max_id, next_id))
 
     return missing_ranges
 
 
+def validate_entries(entries: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+    """
+    Same as validate, but works on the rows of a crawl directory manifest (as returned by
+    manifest.entries) instead of parsing the batch files.
+
+    Returns: List of (start_id, max_id) pairs that are missing from the given entries
+    """
+    missing_ranges: List[Tuple[int, int]] = []
+
+    for entry, next_entry in zip(entries[:-1], entries[1:]):
+        next_id = next_entry["start_id"]
+        if not entry["count"]:
+            missing_ranges.append((entry["start_id"], next_id))
+        elif entry["last_id"] != next_id:
+            missing_ranges.append((entry["last_id"], next_id))
+
+    return missing_ranges
+
+
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
 @click.option(
     "--crawldir",
@@ -311,6 +581,13 @@ def validate_handler(crawldir: str, num_processes: int, outfile: str) -> None:
         ofp = open(outfile, "w")
     invalid = []
 
+    if manifest.has_manifest(crawldir):
+        invalid = validate_entries(manifest.entries(crawldir))
+        json.dump(invalid, ofp)
+        if outfile is not None:
+            ofp.close()
+        return
+
     result_files = ordered_crawl(crawldir)
     if len(result_files) > 1:
         concurrency = num_processes
@@ -360,9 +637,9 @@ def sample(
     assert 0 <= choose_probability <= 1
 
     for batch in tqdm(crawl_batches, desc="batch"):
-        with open(batch, "r") as ifp:
-            result = json.load(ifp)
-        for repository in tqdm(result["data"], desc="repository", leave=False):
+        for repository in tqdm(
+            iter_repositories(batch), desc="repository", leave=False
+        ):
             if random.random() < choose_probability:
                 yield repository
 
@@ -401,12 +678,50 @@ def sample(
     default=None,
     help="GitHub ID to end sampling at (default: None)",
 )
+@click.option(
+    "--size",
+    "-k",
+    type=int,
+    default=None,
+    help="Sample exactly this many repositories instead of sampling with --probability",
+)
+@click.option(
+    "--strata",
+    type=int,
+    default=1,
+    help="With --size, sample proportionally from this many equal-width ID ranges",
+)
+@click.option(
+    "--num-processes",
+    "-n",
+    type=int,
+    default=1,
+    help="Number of processes to use when sampling with --size",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    help="Seed for the random number generator used with --size",
+)
 def sample_handler(
-    crawldir: str, outfile, probability: float, from_id: int, to_id: str
+    crawldir: str,
+    outfile,
+    probability: float,
+    from_id: int,
+    to_id: Optional[int],
+    size: Optional[int],
+    strata: int,
+    num_processes: int,
+    seed: Optional[int],
 ) -> None:
     """
     Writes repositories sampled from a crawl directory to an output file in JSON lines format
 
+    With --size, exactly that many repositories are sampled (uniformly, or stratified by ID range
+    with --strata) by a pool of worker processes. Otherwise every repository is chosen
+    independently with the given probability.
+
     Args:
     args
         Namespace containing arguments parsed from command line
@@ -423,8 +738,52 @@ def sample_handler(
         return True
 
     with outfile as ofp:
-        ordered_batches = ordered_crawl(crawldir)
-        valid_batches = [batch[0] for batch in ordered_batches if is_valid(batch)]
-        samples = sample(valid_batches, probability)
+        batches: List[Tuple[str, int, Optional[int]]] = []
+        if manifest.has_manifest(crawldir):
+            entries = manifest.entries(crawldir, from_id, to_id)
+            batches = [
+                (entry["path"], entry["start_id"], entry["count"]) for entry in entries
+            ]
+        else:
+            ordered_batches = ordered_crawl(crawldir)
+            batches = [
+                (path, start_id, None)
+                for path, start_id in ordered_batches
+                if is_valid((path, start_id))
+            ]
+
+        samples: Iterable[Dict[str, Any]]
+        if size is not None:
+            samples = sample_fixed_size(batches, size, strata, num_processes, seed)
+        else:
+            samples = sample([batch[0] for batch in batches], probability)
         for repository in samples:
             print(json.dumps(repository), file=ofp)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option(
+    "--crawldir",
+    "-d",
+    help="Path to directory containing the results of an allrepos crawl",
+)
+@click.option(
+    "--num-processes",
+    "-p",
+    type=int,
+    default=1,
+    help="Number of processes to use when parsing batch files",
+)
+def reindex_handler(crawldir: str, num_processes: int) -> None:
+    """
+    Rebuilds the manifest of a crawl directory from the batch files in it.
+
+    Args:
+    crawldir
+        Output directory for an allrepos crawl
+    num_processes
+        Number of processes to use when parsing batch files
+
+    Returns: None. Prints the number of indexed batch files to screen.
+    """
+    print(manifest.reindex(crawldir, num_processes))
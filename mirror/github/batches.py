@@ -0,0 +1,283 @@
+"""
+Reading and writing of allrepos crawl batch files.
+
+Batches are stored in one of two layouts, distinguished by file extension:
+
+1. <start_id>.json - a single JSON object holding the whole batch:
+   {"start_id": ..., "max_id": ..., "data": [<repository>, ...], "start": ..., "end": ..., ...}
+
+2. <start_id>.jsonl, <start_id>.jsonl.gz, <start_id>.jsonl.zst - JSON lines, optionally compressed
+   with gzip or zstd. The first line is a header record, every following line is one repository and
+   the last line is a footer record:
+   {"mirror_record": "header", "command": "crawl", "start_id": ..., "max_id": ..., "start": ...}
+   <repository>
+   ...
+   {"mirror_record": "footer", "max_id": ..., "end": ..., "count": ..., "ending_rate_limit": ...}
+
+JSON lines batches are written page by page as the crawl proceeds and read record by record, so
+neither side has to hold a whole batch in memory.
+"""
+
+import glob
+import gzip
+import json
+import os
+from typing import Any, Dict, IO, Iterator, List, Optional
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None  # type: ignore
+
+FORMATS = {
+    "json": ".json",
+    "jsonl": ".jsonl",
+    "jsonl.gz": ".jsonl.gz",
+    "jsonl.zst": ".jsonl.zst",
+}
+DEFAULT_FORMAT = "json"
+
+RECORD_TYPE_KEY = "mirror_record"
+HEADER_RECORD = "header"
+FOOTER_RECORD = "footer"
+
+
+class BatchFormatError(Exception):
+    """Raised when a batch file can not be read or written in the requested format."""
+
+    pass
+
+
+def batch_format(path: str) -> str:
+    """
+    Returns the format of the batch file at the given path, based on its extension.
+    """
+    basename = os.path.basename(path)
+    for name, extension in sorted(
+        FORMATS.items(), key=lambda item: len(item[1]), reverse=True
+    ):
+        if basename.endswith(extension):
+            return name
+    raise BatchFormatError(f"Unknown batch file format: {path}")
+
+
+def batch_path(crawldir: str, start_id: int, format: str = DEFAULT_FORMAT) -> str:
+    """
+    Returns the path of the batch file starting at the given ID.
+    """
+    return os.path.join(crawldir, f"{start_id}{FORMATS[format]}")
+
+
+def batch_start_id(path: str) -> int:
+    """
+    Returns the start ID encoded in the name of the given batch file.
+    """
+    return int(os.path.basename(path).split(".")[0])
+
+
+def list_batches(crawldir: str) -> List[str]:
+    """
+    Returns the paths of all batch files (in any format) in the given crawl directory.
+    """
+    result_files: List[str] = []
+    for extension in FORMATS.values():
+        result_files.extend(glob.glob(os.path.join(crawldir, f"*{extension}")))
+    return result_files
+
+
+def open_text(path: str, mode: str = "r") -> IO[str]:
+    """
+    Opens a batch file in text mode, transparently (de)compressing gzip and zstd files.
+    """
+    format = batch_format(path)
+    if format == "jsonl.gz":
+        return gzip.open(path, f"{mode}t", encoding="utf8")  # type: ignore
+    if format == "jsonl.zst":
+        if zstandard is None:
+            raise BatchFormatError(
+                "zstd batches require the zstandard package: pip install mirror[zstd]"
+            )
+        return zstandard.open(path, f"{mode}t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+
+def is_record(item: Dict[str, Any], record_type: str) -> bool:
+    return item.get(RECORD_TYPE_KEY) == record_type
+
+
+def iter_repositories(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the repositories stored in the given batch file, in order.
+    """
+    if batch_format(path) == "json":
+        with open(path, "r") as ifp:
+            result = json.load(ifp)
+        yield from result.get("data", [])
+        return
+
+    with open_text(path) as ifp:
+        for line in ifp:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if RECORD_TYPE_KEY in item:
+                continue
+            yield item
+
+
+def batch_summary(path: str) -> Dict[str, Any]:
+    """
+    Returns the start ID, first and last repository ID and number of repositories in the given
+    batch file without keeping its repositories in memory.
+    """
+    summary: Dict[str, Any] = {
+        "start_id": batch_start_id(path),
+        "first_id": None,
+        "last_id": None,
+        "count": 0,
+    }
+    for repository in iter_repositories(path):
+        repository_id = repository.get("id", -1)
+        if summary["first_id"] is None:
+            summary["first_id"] = repository_id
+        summary["last_id"] = repository_id
+        summary["count"] += 1
+    return summary
+
+
+class BatchWriter:
+    """
+    Writes a single crawl batch file. Pages of repositories are passed to write() as they arrive
+    from the API and the batch is finalized by close().
+
+    If max_repository_id is set, repositories with larger IDs are dropped.
+    """
+
+    def __init__(
+        self,
+        crawldir: str,
+        start_id: int,
+        format: str = DEFAULT_FORMAT,
+        max_repository_id: Optional[int] = None,
+    ) -> None:
+        if format not in FORMATS:
+            raise BatchFormatError(f"Unknown batch file format: {format}")
+        self.path = batch_path(crawldir, start_id, format)
+        self.format = format
+        self.start_id = start_id
+        self.max_repository_id = max_repository_id
+        self.count = 0
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+        self._data: List[Dict[str, Any]] = []
+        self._ofp: Optional[IO[str]] = None
+
+    def _write_line(self, item: Dict[str, Any]) -> None:
+        assert self._ofp is not None
+        self._ofp.write(json.dumps(item))
+        self._ofp.write("\n")
+
+    def write_header(self, result: Dict[str, Any]) -> None:
+        """
+        Opens the batch file. For JSON lines batches, this writes the header record built from the
+        metadata in the given (still empty) crawl result.
+        """
+        if self.format == "json" or self._ofp is not None:
+            return
+        self._ofp = open_text(self.path, "w")
+        header = {
+            RECORD_TYPE_KEY: HEADER_RECORD,
+            "command": "crawl",
+            "start_id": result.get("start_id", self.start_id),
+            "max_id": result.get("max_id"),
+            "start": result.get("start"),
+        }
+        self._write_line(header)
+
+    def write(self, repositories: List[Dict[str, Any]]) -> None:
+        if self.max_repository_id is not None:
+            repositories = [
+                repository
+                for repository in repositories
+                if repository.get("id", -1) <= self.max_repository_id
+            ]
+        if not repositories:
+            return
+
+        if self.format == "json":
+            self._data.extend(repositories)
+        else:
+            if self._ofp is None:
+                self.write_header({"start_id": self.start_id})
+            for repository in repositories:
+                self._write_line(repository)
+
+        if self.first_id is None:
+            self.first_id = repositories[0].get("id")
+        self.count += len(repositories)
+        self.last_id = repositories[-1].get("id")
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the summary of the written batch in the format of batch_summary.
+        """
+        return {
+            "start_id": self.start_id,
+            "first_id": self.first_id,
+            "last_id": self.last_id,
+            "count": self.count,
+        }
+
+    def close(self, result: Dict[str, Any], keep_empty: bool = True) -> None:
+        """
+        Finalizes the batch with the metadata in the given crawl result. If keep_empty is False and
+        no repositories were written, the batch file is removed instead.
+        """
+        max_id = self.last_id if self.count else result.get("max_id")
+        if self.format == "json":
+            if self.count or keep_empty:
+                with open(self.path, "w") as ofp:
+                    json.dump({**result, "max_id": max_id, "data": self._data}, ofp)
+            self._data = []
+            return
+
+        if self._ofp is None:
+            self.write_header(result)
+        footer = {
+            RECORD_TYPE_KEY: FOOTER_RECORD,
+            "max_id": max_id,
+            "end": result.get("end"),
+            "count": self.count,
+            "ending_rate_limit": result.get("ending_rate_limit"),
+        }
+        self._write_line(footer)
+        assert self._ofp is not None
+        self._ofp.close()
+        self._ofp = None
+        if not self.count and not keep_empty:
+            os.remove(self.path)
+
+
+def rewrite_start_id(path: str, start_id: int) -> str:
+    """
+    Moves the given batch file to the name for a batch starting at start_id, updating the start ID
+    recorded inside of it. Returns the new path.
+    """
+    format = batch_format(path)
+    new_path = batch_path(os.path.dirname(path), start_id, format)
+    if format == "json":
+        with open(path, "r") as ifp:
+            result = json.load(ifp)
+        result["start_id"] = start_id
+        with open(new_path, "w") as ofp:
+            json.dump(result, ofp)
+    else:
+        with open_text(path) as ifp, open_text(new_path, "w") as ofp:
+            for line in ifp:
+                item = json.loads(line)
+                if is_record(item, HEADER_RECORD):
+                    item["start_id"] = start_id
+                    line = json.dumps(item) + "\n"
+                ofp.write(line)
+    os.remove(path)
+    return new_path
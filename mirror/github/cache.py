@@ -0,0 +1,183 @@
+"""
+Persistent cache of GitHub API responses, revalidated with ETag / Last-Modified.
+
+GitHub does not count 304 Not Modified responses against the rate limit, so re-running a command
+over the same repositories only pays for the responses which actually changed. Entries are keyed
+by URL and token (tokens are only stored as hashes) and the cache is kept under a maximum size by
+evicting the least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CACHE_FILE = "responses.sqlite"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+ETAG_HEADER = "ETag"
+LAST_MODIFIED_HEADER = "Last-Modified"
+
+
+def cache_key(
+    url: str, params: Optional[Dict[str, Any]], authorization: Optional[str]
+) -> str:
+    """
+    Returns the cache key for a request to the given URL, made with the given Authorization header.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(url.encode("utf8"))
+    hasher.update(json.dumps(params or {}, sort_keys=True).encode("utf8"))
+    hasher.update((authorization or "").encode("utf8"))
+    return hasher.hexdigest()
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache of response bodies stored in a SQLite database.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, CACHE_FILE), check_same_thread=False
+        )
+        create_responses = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        """
+        self._conn.execute(create_responses)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at);"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses;"
+        ).fetchone()[0]
+
+    def conditional_headers(self, key: str) -> Dict[str, str]:
+        """
+        Returns the If-None-Match / If-Modified-Since headers to revalidate the entry with the
+        given key, or an empty dictionary if nothing is cached for it.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified FROM responses WHERE key = ?;", (key,)
+            ).fetchone()
+        if row is None:
+            return {}
+        etag, last_modified = row
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def revalidated(
+        self, key: str, not_modified: requests.Response
+    ) -> Optional[requests.Response]:
+        """
+        Builds the full response for a 304 Not Modified answer from the cached entry. Headers of
+        the 304 response (rate limit, date) take precedence over the cached ones.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT headers, body FROM responses WHERE key = ?;", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?;",
+                (time.time(), key),
+            )
+            self._conn.commit()
+
+        raw_headers, body = row
+        response = requests.Response()
+        response.status_code = 200
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.headers = CaseInsensitiveDict(json.loads(raw_headers))
+        response.headers.update(not_modified.headers)
+        response._content = zlib.decompress(body)
+        response.encoding = not_modified.encoding or "utf-8"
+        return response
+
+    def store(self, key: str, response: requests.Response) -> None:
+        """
+        Caches a successful response if GitHub sent a validator (ETag or Last-Modified) with it.
+        """
+        etag = response.headers.get(ETAG_HEADER)
+        last_modified = response.headers.get(LAST_MODIFIED_HEADER)
+        if response.status_code != 200 or (etag is None and last_modified is None):
+            return
+
+        body = zlib.compress(response.content)
+        headers = json.dumps(dict(response.headers))
+        size = len(body) + len(headers)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?;", (key,)
+            ).fetchone()
+            if previous is not None:
+                self._size -= previous[0]
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                    (key, url, etag, last_modified, headers, body, size, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                """,
+                (
+                    key,
+                    response.url,
+                    etag,
+                    last_modified,
+                    headers,
+                    body,
+                    size,
+                    time.time(),
+                ),
+            )
+            self._size += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at ASC LIMIT 100;"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                return
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?;", (key,))
+                self._size -= size
+                if self._size <= self.max_bytes:
+                    return
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,241 @@
+"""
+Catalog of the repositories cloned by "mirror clone".
+
+The catalog is an append-only SQLite database (.mirror_catalog.sqlite) at the root of the clone
+directory. Every clone appends a row with the meta.json entry of the repository, and the newest row
+of a repository (by owner and name) describes its clone. clone and generate_snippets query the
+catalog by owner, language or commit hash instead of reading the meta.json file of every owner.
+
+The per-owner meta.json files of earlier versions are still written by export_meta, and clone
+directories which only have meta.json files are imported into a new catalog by import_meta.
+
+Run this module to (re)write the meta.json files of a clone directory from its catalog:
+    python -m mirror.github.catalog --clone-dir <clone dir>
+"""
+
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import click
+
+from ..settings import module_version
+
+CATALOG_FILE = ".mirror_catalog.sqlite"
+META_FILE = "meta.json"
+
+COLUMNS = [
+    "repo_id",
+    "owner",
+    "name",
+    "language",
+    "commit_hash",
+    "cloned_at",
+    "entry",
+]
+
+insert_clone = f"""
+INSERT INTO clones({", ".join(COLUMNS)})
+VALUES ({", ".join(["?"] * len(COLUMNS))});
+"""
+
+# Newest row of every repository
+select_latest = """
+SELECT owner, name, language, entry FROM clones
+WHERE id IN (SELECT MAX(id) FROM clones GROUP BY owner, name)
+"""
+
+
+def catalog_path(clone_dir: str) -> str:
+    return os.path.join(clone_dir, CATALOG_FILE)
+
+
+def open_catalog(clone_dir: str) -> sqlite3.Connection:
+    """
+    Opens (and if necessary creates) the catalog of the given clone directory. A new catalog of a
+    clone directory with meta.json files is filled from them.
+    """
+    conn = sqlite3.connect(catalog_path(clone_dir), timeout=60)
+
+    create_clones = """
+    CREATE TABLE IF NOT EXISTS clones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        repo_id UNSIGNED BIG INT,
+        owner TEXT NOT NULL,
+        name TEXT NOT NULL,
+        language TEXT,
+        commit_hash TEXT,
+        cloned_at TEXT,
+        entry TEXT NOT NULL
+    );
+    """
+    create_indexes = [
+        "CREATE INDEX IF NOT EXISTS clones_owner_name ON clones(owner, name);",
+        "CREATE INDEX IF NOT EXISTS clones_language ON clones(language);",
+        "CREATE INDEX IF NOT EXISTS clones_commit_hash ON clones(commit_hash);",
+    ]
+
+    c = conn.cursor()
+    c.execute(create_clones)
+    for create_index in create_indexes:
+        c.execute(create_index)
+    conn.commit()
+
+    if c.execute("SELECT COUNT(*) FROM clones;").fetchone()[0] == 0:
+        import_meta(conn, clone_dir)
+    return conn
+
+
+def record_clone(
+    conn: sqlite3.Connection,
+    owner: str,
+    language: Optional[str],
+    entry: Dict[str, Any],
+    repo_id: Optional[int] = None,
+) -> None:
+    """
+    Appends the meta.json entry of a clone of the given owner to the catalog.
+    """
+    conn.execute(
+        insert_clone,
+        (
+            repo_id,
+            owner,
+            entry["name"],
+            language,
+            (entry.get("commit_hash") or "").strip() or None,
+            datetime.now(timezone.utc).isoformat(),
+            json.dumps(entry),
+        ),
+    )
+    conn.commit()
+
+
+def get_clone(
+    conn: sqlite3.Connection, owner: str, name: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Returns the meta.json entry of the current clone of the given repository, if there is one.
+    """
+    row = conn.execute(
+        "SELECT entry FROM clones WHERE owner = ? AND name = ? ORDER BY id DESC LIMIT 1;",
+        (owner, name),
+    ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def latest_clones(
+    conn: sqlite3.Connection,
+    owner: Optional[str] = None,
+    language: Optional[str] = None,
+    commit_hash: Optional[str] = None,
+) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Returns the current clones in the catalog, optionally only those of the given owner, language
+    or commit hash.
+
+    Returns: List of (owner, language, meta.json entry) triples, ordered by owner and name
+    """
+    conditions = []
+    params: List[Any] = []
+    for column, value in (
+        ("owner", owner),
+        ("language", language),
+        ("commit_hash", commit_hash),
+    ):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+
+    query = select_latest
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+    query += " ORDER BY owner, name;"
+
+    return [
+        (row_owner, row_language, json.loads(entry))
+        for row_owner, _, row_language, entry in conn.execute(query, params)
+    ]
+
+
+def export_meta(
+    conn: sqlite3.Connection, clone_dir: str, owners: Optional[Iterable[str]] = None
+) -> None:
+    """
+    Writes the meta.json file of every owner in the catalog (or only of the given owners) in the
+    layout of earlier versions of clone.
+    """
+    by_owner: Dict[str, List[Tuple[Optional[str], Dict[str, Any]]]] = {}
+    if owners is None:
+        for owner, language, entry in latest_clones(conn):
+            by_owner.setdefault(owner, []).append((language, entry))
+    else:
+        for owner in owners:
+            by_owner[owner] = [
+                (language, entry) for _, language, entry in latest_clones(conn, owner)
+            ]
+
+    for owner, clones in by_owner.items():
+        organization_path = os.path.join(clone_dir, owner)
+        if not clones or not os.path.isdir(organization_path):
+            continue
+        with open(os.path.join(organization_path, META_FILE), "w") as meta:
+            json.dump(
+                {
+                    "language": clones[0][0],
+                    "repos": [entry for _, entry in clones],
+                    "crawled_at": None,
+                    "mirror version": module_version,
+                },
+                meta,
+            )
+
+
+def import_meta(conn: sqlite3.Connection, clone_dir: str) -> None:
+    """
+    Appends the entries of the meta.json files in the given clone directory to the catalog.
+    """
+    for owner in sorted(os.listdir(clone_dir)):
+        meta_path = os.path.join(clone_dir, owner, META_FILE)
+        if not os.path.isfile(meta_path):
+            continue
+
+        with open(meta_path, "r") as meta:
+            meta_data = json.load(meta)
+
+        for entry in meta_data["repos"]:
+            conn.execute(
+                insert_clone,
+                (
+                    None,
+                    owner,
+                    entry["name"],
+                    meta_data.get("language"),
+                    (entry.get("commit_hash") or "").strip() or None,
+                    None,
+                    json.dumps(entry),
+                ),
+            )
+    conn.commit()
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--clone-dir", "-C", required=True, help="Dir with cloned repos.")
+@click.option(
+    "--owner", "-o", default=None, help="Only write the meta.json of this owner."
+)
+def export_meta_handler(clone_dir: str, owner: Optional[str]) -> None:
+    """
+    Write the meta.json files of a clone directory from its catalog.
+    """
+    conn = open_catalog(clone_dir)
+    export_meta(conn, clone_dir, [owner] if owner is not None else None)
+    conn.close()
+
+
+if __name__ == "__main__":
+    export_meta_handler()
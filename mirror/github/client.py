@@ -0,0 +1,189 @@
+"""
+Shared HTTP client for all requests mirror makes to the GitHub API.
+
+All commands go through a single persistent requests.Session so that TLS connections are pooled
+and kept alive between requests. Requests that fail with a timeout, a connection error, a 5xx
+response or a secondary rate limit are retried with jittered exponential backoff, honouring the
+Retry-After header when GitHub sends one.
+
+If a response cache is configured (see configure_cache), requests are sent as conditional requests
+and 304 Not Modified answers are served from the cache.
+"""
+
+from email.utils import parsedate_to_datetime
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..settings import (
+    MIRROR_HTTP_CACHE_DIR,
+    MIRROR_HTTP_MAX_RETRIES,
+    MIRROR_HTTP_TIMEOUT_SECONDS,
+)
+from .cache import DEFAULT_MAX_BYTES, ResponseCache, cache_key
+
+DEFAULT_TIMEOUT_SECONDS = 30.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 120.0
+POOL_SIZE = 32
+
+RETRY_AFTER_HEADER = "Retry-After"
+REMAINING_RATELIMIT_HEADER = "X-RateLimit-Remaining"
+
+timeout = float(MIRROR_HTTP_TIMEOUT_SECONDS or DEFAULT_TIMEOUT_SECONDS)
+max_retries = int(MIRROR_HTTP_MAX_RETRIES or DEFAULT_MAX_RETRIES)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the process-wide session, creating it on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["User-Agent"] = "simiotics mirror"
+            _session = session
+        return _session
+
+
+def configure_cache(
+    cache_dir: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES
+) -> None:
+    """
+    Enables the on-disk response cache in the given directory. If no directory is given,
+    $MIRROR_HTTP_CACHE_DIR is used; if that is not set either, caching stays disabled.
+    """
+    global _cache
+    if cache_dir is None:
+        cache_dir = MIRROR_HTTP_CACHE_DIR
+    if not cache_dir:
+        return
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(cache_dir, max_bytes)
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Returns the number of seconds GitHub asked us to wait in the Retry-After header, if any.
+    """
+    raw_value = response.headers.get(RETRY_AFTER_HEADER)
+    if raw_value is None:
+        return None
+    try:
+        return max(float(raw_value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(raw_value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(response: requests.Response) -> bool:
+    """
+    Returns True if the response is a transient failure which should be retried.
+
+    Exhausted primary rate limits (X-RateLimit-Remaining: 0) are not retried here - they are the
+    responsibility of the token pool, which can switch to another token.
+    """
+    if response.status_code >= 500:
+        return True
+    if response.status_code in (403, 429):
+        if response.headers.get(REMAINING_RATELIMIT_HEADER) == "0":
+            return False
+        if response.status_code == 429 or RETRY_AFTER_HEADER in response.headers:
+            return True
+        return "secondary rate limit" in response.text.lower()
+    return False
+
+
+def backoff(attempt: int) -> float:
+    """
+    Returns a jittered, exponentially growing delay (in seconds) for the given retry attempt.
+    """
+    cap = min(MAX_BACKOFF_SECONDS, DEFAULT_BACKOFF_SECONDS * 2**attempt)
+    return random.uniform(cap / 2, cap)
+
+
+def get(
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None,
+    retries: Optional[int] = None,
+) -> requests.Response:
+    """
+    GET the given URL through the shared session, retrying transient failures.
+
+    Args:
+    url
+        URL to request
+    params
+        Query parameters
+    headers
+        Request headers (in addition to the session headers)
+    retries
+        Maximum number of retries (default: $MIRROR_HTTP_MAX_RETRIES or 5)
+
+    Returns: The last response received. Raises the last requests.RequestException if no response
+    could be received at all.
+    """
+    if retries is None:
+        retries = max_retries
+    session = get_session()
+
+    cache = _cache
+    key = ""
+    request_headers = dict(headers or {})
+    if cache is not None:
+        key = cache_key(url, params, request_headers.get("Authorization"))
+        request_headers.update(cache.conditional_headers(key))
+
+    attempt = 0
+    while True:
+        try:
+            response = session.get(
+                url, params=params, headers=request_headers, timeout=timeout
+            )
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt >= retries:
+                raise
+            delay = backoff(attempt)
+            print(
+                f"Request to {url} failed ({repr(err)}), retrying in {delay:.1f}s",
+                file=sys.stderr,
+            )
+        else:
+            if attempt >= retries or not is_retryable(response):
+                break
+            delay = retry_after(response) or backoff(attempt)
+            print(
+                f"Request to {url} returned {response.status_code}, retrying in {delay:.1f}s",
+                file=sys.stderr,
+            )
+        time.sleep(delay)
+        attempt += 1
+
+    if cache is not None:
+        if response.status_code == 304:
+            cached_response = cache.revalidated(key, response)
+            if cached_response is not None:
+                return cached_response
+        else:
+            cache.store(key, response)
+    return response
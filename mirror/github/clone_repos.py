@@ -1,18 +1,43 @@
 import os
 import json
 import time
+import shutil
+import signal
+import threading
 import traceback
 import subprocess
-from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import click
 import requests
 
-from ..settings import module_version
-from .utils import get_nearest_value, read_command_type, forward_languages_config
+from .catalog import export_meta, get_clone, open_catalog, record_clone
+from .ranges import get_repos_files, read_repos
+from .tokens import TokenPool, load_tokens
+from .utils import forward_languages_config, request_with_limit
 
 DATETIME_HEADER = "Date"
 
+DEFAULT_CLONE_TIMEOUT = 1800
+
+# Bare clones of the sources of fork networks, relative to the clone dir
+NETWORKS_DIR = ".mirror_networks"
+
+MEGABYTE = 1024 * 1024
+
+# Orders in which repos can be cloned: as listed in the repos files, smallest first, or most
+# stars per byte first
+ORDERS = ["file", "repos-per-byte", "stars-per-byte"]
+
+# git processes which are currently running, so that they can be killed on interrupt
+_running: Set[subprocess.Popen] = set()
+_running_lock = threading.Lock()
+
+# Bare clone path -> lock held while the bare clone is created
+_network_locks: Dict[str, threading.Lock] = {}
+_network_locks_lock = threading.Lock()
+
 
 class CommandNotExistError(Exception):
     """Raised when coomand is not exist."""
@@ -20,6 +45,12 @@ class CommandNotExistError(Exception):
     pass
 
 
+class CloneError(Exception):
+    """Raised when git clone fails or times out."""
+
+    pass
+
+
 def get_lang(repo):
     """
     Return name of output language folder
@@ -43,90 +74,375 @@ def check_command(name):
     return which(name) is not None
 
 
-def create_dir_meta_if_not_exists(lang_path: str, meta_file: str, lang: str):
+def kill_process(process: subprocess.Popen) -> None:
+    """
+    Kills the given process together with the processes it started (git clone runs helpers such as
+    git-remote-https and git-index-pack). The process must have been started in a new session.
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
 
+def kill_running() -> None:
     """
-    Create nessesary structure
+    Kills all running git processes.
     """
+    with _running_lock:
+        processes = list(_running)
+    for process in processes:
+        kill_process(process)
 
-    if not os.path.exists(lang_path):
-        os.makedirs(lang_path)
 
-    if not os.path.exists(meta_file):
-        with open(meta_file, "w") as meta:
-            json.dump(
-                {
-                    "language": lang,
-                    "repos": [],
-                    "crawled_at": None,
-                    "mirror version": module_version,
-                },
-                meta,
-            )
+def run_git(
+    args: List[str], cwd: str, timeout: Optional[float] = None, capture: bool = False
+) -> str:
+    """
+    Runs a git command, killing it (and the processes it started) after timeout seconds.
 
+    Returns: Standard output of the command if capture is set, otherwise an empty string
 
-def read_repos(repos_dir, file_name, start_id, end_id):
+    Raises: CloneError if git fails or times out
+    """
+    # Never wait for credentials of repositories which have become private or been removed
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    process = subprocess.Popen(
+        args,
+        cwd=cwd,
+        env=env,
+        start_new_session=True,
+        stdout=subprocess.PIPE if capture else None,
+        encoding="utf8",
+    )
+    with _running_lock:
+        _running.add(process)
+    try:
+        stdout, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process(process)
+        process.communicate()
+        raise CloneError(f"{' '.join(args)} timed out after {timeout} seconds")
+    finally:
+        with _running_lock:
+            _running.discard(process)
+
+    if process.returncode != 0:
+        raise CloneError(f"{' '.join(args)} exited with code {process.returncode}")
+    return stdout or ""
+
+
+def sparse_patterns(language_to_extensions: Dict[str, List[str]]) -> List[str]:
     """
-    Read repos from file. Filter repos by given repo id range if specified.
+    Returns sparse-checkout patterns which match the files with the extensions of a languages
+    config ({"<language>": ["<extension>", ...], ...}) anywhere in a repository.
     """
-    repos_file_path = os.path.join(repos_dir, file_name)
+    patterns = set()
+    for extensions in language_to_extensions.values():
+        for extension in extensions:
+            extension = extension.lstrip(".")
+            if not extension:
+                continue
+            # generate_snippets matches extensions case-insensitively
+            patterns.add(f"*.{extension.lower()}")
+            patterns.add(f"*.{extension.upper()}")
+    return sorted(patterns)
 
-    # load available repo
-    if os.path.isfile(repos_file_path):
-        with open(repos_file_path, "r") as repos_file:
-            if start_id and end_id:
-                return [repo for repo in json.load(repos_file)["data"] if repo["id"]]
-            else:
-                return json.load(repos_file)["data"]
 
+def clone_repository(
+    git_url: str,
+    out_path: str,
+    depth: Optional[int] = None,
+    timeout: Optional[float] = None,
+    name: Optional[str] = None,
+    patterns: Optional[List[str]] = None,
+    reference: Optional[str] = None,
+) -> None:
+    """
+    Clones the given repository into out_path.
+
+    Args:
+    git_url
+        URL of the repository
+    out_path
+        Directory to clone into
+    depth
+        Clone depth (default: full clone)
+    timeout
+        Seconds after which git is killed (default: no limit)
+    name
+        Name of the clone directory (default: chosen by git). If it is set, a partial clone is
+        removed when the clone fails.
+    patterns
+        Sparse-checkout patterns (see sparse_patterns). If set, the repository is cloned without
+        blobs (--filter=blob:none) and only the blobs of the files which match the patterns are
+        fetched, when they are checked out. Requires name to be set.
+    reference
+        Path to a repository to borrow objects from (git clone --reference). Only the objects
+        which the reference repository does not have are downloaded, and the reference repository
+        must stay in place as long as the clone is used.
+    """
+    target = os.path.join(out_path, name) if name is not None else None
+    if target is not None and os.path.exists(target):
+        raise CloneError(f"{target} already exists")
+    if patterns is not None and target is None:
+        raise CloneError("Sparse clones need the name of the clone directory")
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
 
-def get_repos_files(repos_dir, start_id, end_id):
+    def remaining() -> Optional[float]:
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
 
+    args = ["git", "clone"]
+    if depth is not None:
+        args.extend(["--depth", str(depth)])
+    if patterns is not None:
+        args.extend(["--filter=blob:none", "--no-checkout"])
+    if reference is not None:
+        args.extend(["--reference", reference])
+    args.extend(["--", git_url])
+    if name is not None:
+        args.append(name)
+
+    try:
+        run_git(args, out_path, remaining())
+
+        if patterns is not None and target is not None:
+            run_git(["git", "config", "core.sparseCheckout", "true"], target)
+            info_path = os.path.join(target, ".git", "info")
+            os.makedirs(info_path, exist_ok=True)
+            with open(os.path.join(info_path, "sparse-checkout"), "w") as ofp:
+                ofp.write("".join(f"{pattern}\n" for pattern in patterns))
+            run_git(["git", "checkout", "--quiet"], target, remaining())
+    except CloneError:
+        if target is not None:
+            shutil.rmtree(target, ignore_errors=True)
+        raise
+
+
+def meta_entry(repo: Dict[str, Any], commit_hash: str) -> Dict[str, Any]:
+    """
+    Returns the meta.json entry of a cloned repository.
+    """
+    return {
+        "name": repo["name"],
+        "full_name": repo["full_name"],
+        "github_repo_url": repo["html_url"],
+        "commit_hash": commit_hash,
+        "license": repo["license"],
+        "fork": repo["fork"],
+        "description": repo["description"],
+        "created_at": repo["created_at"],
+        "updated_at": repo["updated_at"],
+        "pushed_at": repo["pushed_at"],
+        "stargazers_count": repo["stargazers_count"],
+        "watchers_count": repo["stargazers_count"],
+        "forks": repo["stargazers_count"],
+        "open_issues": repo["open_issues"],
+        "private": repo["private"],
+        "owner": {
+            "type": repo["owner"]["type"],
+            "html_url": repo["owner"]["html_url"],
+        },
+    }
+
+
+def fork_source(
+    repo: Dict[str, Any], pool: TokenPool, min_rate_limit: int
+) -> Optional[Dict[str, Any]]:
+    """
+    Returns the metadata of the source repository of the fork network of the given fork (the
+    repository at the root of the network), or None if it is not known.
     """
-    Return list of files with repose by given ids range or all files from folder if ids range not set
+    headers = {"accept": "application/vnd.github.v3+json"}
+    response = request_with_limit(repo["url"], headers, min_rate_limit, pool)
+    if response.status_code != 200:
+        return None
+    return response.json().get("source")
 
-    In order to make sure that all repositories are covered,
-    add 2 additional files from the beginning of the ordered directory list and from the end
 
+def network_reference(
+    crawldir: str,
+    source: Dict[str, Any],
+    timeout: Optional[float] = None,
+    patterns: Optional[List[str]] = None,
+) -> Tuple[str, int]:
     """
+    Returns the path of the bare clone of the source of a fork network, which the forks in the
+    network are cloned with as --reference. It is cloned the first time it is needed and is
+    never changed afterwards, so clones which borrow objects from it stay valid.
 
-    dir_files = [
-        filename
-        for filename in os.listdir(repos_dir)
-        if filename != "languages_config.json"
-    ]
+    Returns: Pair of (path of the bare clone, bytes it takes up if it was created by this call,
+    otherwise 0)
+    """
+    path = os.path.join(
+        crawldir, NETWORKS_DIR, source["owner"]["login"], f"{source['name']}.git"
+    )
+    with _network_locks_lock:
+        lock = _network_locks.setdefault(path, threading.Lock())
+
+    created_bytes = 0
+    with lock:
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            args = ["git", "clone", "--bare", "--quiet"]
+            if patterns is not None:
+                args.append("--filter=blob:none")
+            args.extend(["--", source["git_url"], path])
+            try:
+                run_git(args, crawldir, timeout)
+            except CloneError:
+                shutil.rmtree(path, ignore_errors=True)
+                raise
+            created_bytes = directory_size(path)
+    return path, created_bytes
+
+
+def head_commit(repo_path: str) -> str:
+    return subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE,
+        cwd=repo_path,
+    ).stdout.decode("utf8")
+
+
+def clone_task(
+    repo: Dict[str, Any],
+    crawldir: str,
+    depth: Optional[int] = None,
+    timeout: Optional[float] = None,
+    patterns: Optional[List[str]] = None,
+    pool: Optional[TokenPool] = None,
+    min_rate_limit: int = 0,
+) -> Tuple[str, Dict[str, Any], int]:
+    """
+    Clones a repository into <crawldir>/<owner>/<name>.
 
-    if not dir_files:
-        raise ("Empty repos dir.")
+    If a token pool is given, forks borrow the objects of the source of their fork network from a
+    shared bare clone (see network_reference), so objects common to the network are downloaded
+    and stored once.
 
-    result_command_type = read_command_type(os.path.join(repos_dir, dir_files[0]))
+    Returns: Triple of ("cloned", meta.json entry of the clone, bytes taken up by the bare clone
+    of the fork network if this clone created it, otherwise 0)
+    """
+    organization_path = os.path.join(crawldir, repo["owner"]["login"])
+    os.makedirs(organization_path, exist_ok=True)
+
+    reference = None
+    network_bytes = 0
+    if pool is not None and repo.get("fork"):
+        try:
+            source = fork_source(repo, pool, min_rate_limit)
+            if source is not None:
+                reference, network_bytes = network_reference(
+                    crawldir, source, timeout, patterns
+                )
+        except Exception as err:
+            print(f"Cloning fork {repo['full_name']} without its network: {err}")
+
+    clone_repository(
+        repo["git_url"],
+        organization_path,
+        depth,
+        timeout,
+        repo["name"],
+        patterns,
+        reference,
+    )
+
+    commit_hash = head_commit(os.path.join(organization_path, repo["name"]))
+    return "cloned", meta_entry(repo, commit_hash), network_bytes
+
+
+def update_task(
+    repo: Dict[str, Any],
+    crawldir: str,
+    recorded_hash: Optional[str],
+    depth: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> Tuple[str, Dict[str, Any], int]:
+    """
+    Brings an existing clone in <crawldir>/<owner>/<name> up to date with the HEAD of its remote.
+    Nothing is fetched if the remote HEAD is the recorded commit. Otherwise the remote HEAD is
+    fetched (with the given depth, if any) and the clone is reset to it. Sparse checkouts and
+    blobless clones stay sparse and blobless.
 
-    if start_id and end_id and result_command_type == "crawl":
+    Returns: Triple of ("updated" or "unchanged", meta.json entry of the clone, 0) - the last
+    item matches clone_task
+    """
+    repo_path = os.path.join(crawldir, repo["owner"]["login"], repo["name"])
+    deadline = time.monotonic() + timeout if timeout is not None else None
 
-        nerest_start_id = get_nearest_value(dir_files, start_id)
+    def remaining() -> Optional[float]:
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
 
-        if dir_files.index(f"{nerest_start_id}.json") - 2 <= 0:
-            start_index = 0
-        else:
-            start_file = dir_files.index(f"{nerest_start_id}.json") - 2
+    remote_head = run_git(
+        ["git", "ls-remote", "origin", "HEAD"], repo_path, remaining(), capture=True
+    ).split()
+    if remote_head and recorded_hash and remote_head[0] == recorded_hash.strip():
+        return "unchanged", meta_entry(repo, recorded_hash), 0
 
-        nerest_end_id = get_nearest_value(dir_files, end_id)
+    args = ["git", "fetch", "--quiet"]
+    if depth is not None:
+        args.extend(["--depth", str(depth)])
+    args.extend(["origin", "HEAD"])
+    run_git(args, repo_path, remaining())
+    run_git(["git", "reset", "--quiet", "--hard", "FETCH_HEAD"], repo_path, remaining())
 
-        if dir_files.index(f"{nerest_end_id}.json") + 2 >= len(dir_files):
-            end_index = -1
-        else:
-            end_index = dir_files.index(f"{nerest_end_id}.json") + 2
+    return "updated", meta_entry(repo, head_commit(repo_path)), 0
 
-    else:
-        return dir_files
 
+def predicted_bytes(repo: Dict[str, Any]) -> Optional[int]:
+    """
+    Returns the size of the repository as reported by GitHub (the "size" field, in kilobytes) in
+    bytes, or None if it is not known.
+    """
+    size = repo.get("size")
+    if size is None:
+        return None
+    return size * 1024
 
-def clone_repository(git_url, out_path, depth: int = None):
-    args = f"git clone {git_url}"
-    if depth is not None:
-        args = f"{args} --depth {depth}"
-    pipe = subprocess.Popen(args, shell=True, cwd=out_path)
-    pipe.wait()
+
+def directory_size(path: str) -> int:
+    """
+    Returns the number of bytes of the files under the given path. Symbolic links are not
+    followed.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def order_repos(repos: List[Dict[str, Any]], order: str) -> List[Dict[str, Any]]:
+    """
+    Returns the given repos in the given order (one of ORDERS). Repos of unknown size come last.
+    """
+    if order == "repos-per-byte":
+        return sorted(
+            repos,
+            key=lambda repo: (repo.get("size") is None, repo.get("size") or 0),
+        )
+    if order == "stars-per-byte":
+        return sorted(
+            repos,
+            key=lambda repo: (
+                repo.get("size") is None,
+                -(repo.get("stargazers_count") or 0) / ((repo.get("size") or 0) + 1),
+            ),
+        )
+    return repos
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
@@ -142,7 +458,7 @@ def clone_repository(git_url, out_path, depth: int = None):
     "-e",
     type=int,
     default=None,
-    help="End repo id. You need to specify both parameters start and end id. ",
+    help="End repo id for crawl command output.",
 )
 @click.option(
     "--crawldir", "-d", default=None, help="Dir for cloned repos.", show_default=True
@@ -161,16 +477,116 @@ def clone_repository(git_url, out_path, depth: int = None):
     show_default=True,
     help="Clone depth for each repo - default behavior is to do a full clone",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of repos cloned at the same time.",
+)
+@click.option(
+    "--timeout",
+    type=int,
+    default=DEFAULT_CLONE_TIMEOUT,
+    show_default=True,
+    help="Seconds after which a clone is killed and skipped (0: no limit).",
+)
+@click.option(
+    "--languages-file",
+    "-f",
+    default=None,
+    help="Path to json file with the file extensions of every language. Only files with these extensions are downloaded and checked out.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Update existing clones instead of skipping them. Repos which have not been pushed to since they were cloned are not contacted at all.",
+)
+@click.option(
+    "--fork-networks",
+    is_flag=True,
+    help="Clone forks with --reference to a shared bare clone of the source of their fork network (looked up with the GitHub API).",
+)
+@click.option(
+    "--token",
+    "-t",
+    help="Access token or comma-separated tokens for the fork network lookups. Read from env if not specified.",
+    default=None,
+)
+@click.option(
+    "--min-rate-limit",
+    "-l",
+    type=int,
+    default=10,
+    help="Minimum remaining rate limit on API under which fork network lookups wait for a reset.",
+)
+@click.option(
+    "--max-repo-size",
+    type=int,
+    default=None,
+    help="Skip repos whose size reported by GitHub is larger than this many megabytes.",
+)
+@click.option(
+    "--disk-budget",
+    type=int,
+    default=None,
+    help="Megabytes which the clones of this run may take up. Repos which do not fit any more are skipped.",
+)
+@click.option(
+    "--min-free-space",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Megabytes of free disk space to keep. Once a clone would take the free space below it, the running clones are finished and the run stops.",
+)
+@click.option(
+    "--order",
+    type=click.Choice(ORDERS),
+    default="file",
+    show_default=True,
+    help="Order in which repos are cloned: as listed, smallest first (repos-per-byte), or most stars per byte first.",
+)
 def clone_repos(
     start_id: Optional[int],
     end_id: Optional[int],
     crawldir: str,
     repos_dir: str,
     depth: Optional[int] = None,
+    jobs: int = 1,
+    timeout: int = DEFAULT_CLONE_TIMEOUT,
+    languages_file: Optional[str] = None,
+    incremental: bool = False,
+    fork_networks: bool = False,
+    token: Optional[str] = None,
+    min_rate_limit: int = 10,
+    max_repo_size: Optional[int] = None,
+    disk_budget: Optional[int] = None,
+    min_free_space: int = 0,
+    order: str = "file",
 ):
     """
     Clone repos from search api to output dir.
-    Be careful check of upload size not provide
+
+    The size of every new clone is predicted from the size GitHub reports for the repo, which
+    --max-repo-size, --disk-budget and --min-free-space are checked against. Once a clone is
+    complete, its actual size is reported next to the predicted one and counts against the disk
+    budget instead. Repos can be ordered (--order) so that a budget fits as many repos or stars as
+    possible.
+
+    Up to --jobs repos are cloned at the same time. Clones are recorded in the catalog at the root
+    of the clone dir (see catalog.py) from the main thread only. The meta.json files of the owners
+    of new clones are written from the catalog at the end of the run.
+
+    With --languages-file, repos are cloned without blobs and with a sparse checkout of the files
+    with the extensions in the file, so only the blobs of those files are downloaded.
+
+    With --incremental, existing clones are updated: a repo whose pushed_at is the one recorded in
+    the catalog is skipped, and otherwise its clone is fetched and reset to the remote HEAD if that
+    is not the recorded commit. The new commit is recorded in the catalog.
+
+    With --fork-networks, forks are cloned with --reference to a bare clone of the source of their
+    fork network in <crawldir>/.mirror_networks, which must be kept as long as the clones are.
     """
 
     if not check_command("git"):
@@ -184,73 +600,178 @@ def clone_repos(
             os.path.join(repos_dir, "languages_config.json"), crawldir
         )
 
+    patterns = None
+    if languages_file:
+        with open(languages_file, "r", encoding="utf8") as langs:
+            patterns = sparse_patterns(json.load(langs))
+        forward_languages_config(languages_file, crawldir)
+
+    pool = TokenPool(load_tokens(token), min_rate_limit) if fork_networks else None
+
     # read metadata
     files_for_proccessing = get_repos_files(repos_dir, start_id, end_id)
 
-    with click.progressbar(files_for_proccessing, label="Download repos") as bar:
-        for repos_file in bar:
-            repos = read_repos(repos_dir, repos_file, start_id, end_id)
+    conn = open_catalog(crawldir)
+    # Owners whose meta.json has to be written at the end of the run
+    updated_owners: Set[str] = set()
+
+    # future -> repo
+    pending: Dict[Future, Dict[str, Any]] = {}
+    # future -> predicted size of the clone, for new clones
+    predictions: Dict[Future, int] = {}
+    # Repos found in several metadata files are cloned once
+    submitted: Set[str] = set()
+    # Number of repos by outcome
+    outcomes: Dict[str, int] = {
+        "cloned": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "skipped (size)": 0,
+        "skipped (budget)": 0,
+    }
+    # Predicted and actual bytes of completed clones
+    totals: Dict[str, int] = {"predicted": 0, "actual": 0}
+
+    def collect(return_when: str) -> None:
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            repo = pending.pop(future)
+            predicted = predictions.pop(future, None)
+            try:
+                outcome, entry, network_bytes = future.result()
+                outcomes[outcome] += 1
+                record_clone(
+                    conn, repo["owner"]["login"], get_lang(repo), entry, repo["id"]
+                )
+                updated_owners.add(repo["owner"]["login"])
+                if predicted is not None:
+                    # Objects which a fork borrows from the bare clone of its network are
+                    # not in its own directory - they are charged once, to the clone which
+                    # created the bare clone
+                    actual = network_bytes + directory_size(
+                        os.path.join(crawldir, repo["owner"]["login"], repo["name"])
+                    )
+                    totals["predicted"] += predicted
+                    totals["actual"] += actual
+                    network_note = (
+                        f" (incl. {network_bytes / MEGABYTE:.1f} MB fork network clone)"
+                        if network_bytes
+                        else ""
+                    )
+                    click.echo(
+                        f"{repo['full_name']}: predicted {predicted / MEGABYTE:.1f} MB, actual {actual / MEGABYTE:.1f} MB{network_note}"
+                    )
+            except CloneError as err:
+                print(err)
+            except Exception:
+                traceback.print_exc()
+
+    def fits(predicted: int) -> bool:
+        """
+        Checks a new clone of the given predicted size against the disk budget.
+        """
+        if disk_budget is None:
+            return True
+        in_flight = sum(predictions.values())
+        return totals["actual"] + in_flight + predicted <= disk_budget * MEGABYTE
+
+    def has_free_space(predicted: int) -> bool:
+        free = shutil.disk_usage(crawldir).free
+        return free - sum(predictions.values()) - predicted >= min_free_space * MEGABYTE
+
+    def selected_repos() -> Iterator[Dict[str, Any]]:
+        with click.progressbar(files_for_proccessing, label="Download repos") as bar:
+            for repos_file in bar:
+                for repo in read_repos(repos_dir, repos_file, start_id, end_id):
+                    if repo["full_name"] in submitted:
+                        continue
+                    submitted.add(repo["full_name"])
+                    yield repo
+
+    repos: Iterable[Dict[str, Any]] = selected_repos()
+    if order != "file":
+        repos = order_repos(list(repos), order)
+
+    executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    try:
+        for repo in repos:
+            owner = repo["owner"]["login"]
+            repo_path = os.path.join(crawldir, owner, repo["name"])
+            recorded = None
+            exists = incremental and os.path.isdir(os.path.join(repo_path, ".git"))
+            if exists:
+                recorded = get_clone(conn, owner, repo["name"])
+                if (
+                    recorded is not None
+                    and repo.get("pushed_at") is not None
+                    and recorded.get("pushed_at") == repo["pushed_at"]
+                ):
+                    outcomes["unchanged"] += 1
+                    continue
+
+            while len(pending) >= 2 * max(jobs, 1):
+                collect(FIRST_COMPLETED)
+
+            if exists:
+                future = executor.submit(
+                    update_task,
+                    repo,
+                    crawldir,
+                    recorded["commit_hash"] if recorded is not None else None,
+                    depth,
+                    timeout or None,
+                )
+                pending[future] = repo
+                continue
 
-            if not repos:
+            predicted = predicted_bytes(repo) or 0
+            if max_repo_size is not None and predicted > max_repo_size * MEGABYTE:
+                outcomes["skipped (size)"] += 1
                 continue
+            if not fits(predicted):
+                outcomes["skipped (budget)"] += 1
+                continue
+            if min_free_space and not has_free_space(predicted):
+                # Running clones may turn out smaller than predicted
+                while pending:
+                    collect(FIRST_COMPLETED)
+                if not has_free_space(predicted):
+                    click.echo(
+                        f"Less than {min_free_space} MB of free space would be left, stopping"
+                    )
+                    break
+
+            future = executor.submit(
+                clone_task,
+                repo,
+                crawldir,
+                depth,
+                timeout or None,
+                patterns,
+                pool,
+                min_rate_limit,
+            )
+            pending[future] = repo
+            predictions[future] = predicted
+
+        while pending:
+            collect(FIRST_COMPLETED)
+
+        click.echo(", ".join(f"{k.capitalize()}: {v}" for k, v in outcomes.items()))
+        click.echo(
+            f"Predicted size of new clones: {totals['predicted'] / MEGABYTE:.1f} MB, actual: {totals['actual'] / MEGABYTE:.1f} MB"
+        )
+
+    except KeyboardInterrupt:
+        for future in pending:
+            future.cancel()
+        kill_running()
+        raise KeyboardInterrupt("CTRL+C")
 
-            for repo in repos:
-                try:
-
-                    lang = get_lang(repo)
-
-                    organization_path = os.path.join(crawldir, repo["owner"]["login"])
-
-                    meta_file = os.path.join(organization_path, "meta.json")
-
-                    create_dir_meta_if_not_exists(organization_path, meta_file, lang)
-
-                    git_url = repo["git_url"]
-
-                    clone_repository(git_url, organization_path, depth)
-
-                    commit_hash = subprocess.run(
-                        ["git", "rev-parse", "HEAD"],
-                        stdout=subprocess.PIPE,
-                        cwd=os.path.join(organization_path, repo["name"]),
-                    ).stdout
-
-                    with open(meta_file, "r") as meta:
-                        meta_data = json.load(meta)
-
-                    with open(meta_file, "w") as meta:
-                        # rewind
-
-                        meta_data["repos"].append(
-                            {
-                                "name": repo["name"],
-                                "full_name": repo["full_name"],
-                                "github_repo_url": repo["html_url"],
-                                "commit_hash": commit_hash.decode("utf8"),
-                                "license": repo["license"],
-                                "fork": repo["fork"],
-                                "description": repo["description"],
-                                "created_at": repo["created_at"],
-                                "updated_at": repo["updated_at"],
-                                "pushed_at": repo["pushed_at"],
-                                "stargazers_count": repo["stargazers_count"],
-                                "watchers_count": repo["stargazers_count"],
-                                "forks": repo["stargazers_count"],
-                                "open_issues": repo["open_issues"],
-                                "private": repo["private"],
-                                "owner": {
-                                    "type": repo["owner"]["type"],
-                                    "html_url": repo["owner"]["html_url"],
-                                },
-                            }
-                        )
-                        json.dump(meta_data, meta)
-
-                except KeyboardInterrupt:
-                    raise KeyboardInterrupt("CTRL+C")
-
-                except:
-                    traceback.print_exc()
+    finally:
+        executor.shutdown(wait=True)
+        export_meta(conn, crawldir, updated_owners)
+        conn.close()
 
 
 if __name__ == "__main__":
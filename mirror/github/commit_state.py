@@ -0,0 +1,76 @@
+"""
+Per-repository state of incremental commits runs.
+
+The state is a SQLite database (commits_state.sqlite in the commits crawl directory by default)
+with one row per repository: the SHA and commit date of the newest commit retrieved so far and the
+pushed_at time of the repository when it was retrieved. "mirror commits --incremental" uses it to
+skip repositories which have not been pushed to since the last run and to request only the commits
+which are newer than the newest one it has already seen.
+"""
+
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+STATE_FILE = "commits_state.sqlite"
+
+COLUMNS = ["repo_id", "html_url", "newest_sha", "committed_at", "pushed_at"]
+
+# A repository without new commits keeps the newest commit it already had
+upsert_state = f"""
+INSERT INTO repositories({", ".join(COLUMNS)})
+VALUES ({", ".join(["?"] * len(COLUMNS))})
+ON CONFLICT(repo_id) DO UPDATE SET
+    html_url = excluded.html_url,
+    newest_sha = COALESCE(excluded.newest_sha, newest_sha),
+    committed_at = COALESCE(excluded.committed_at, committed_at),
+    pushed_at = excluded.pushed_at;
+"""
+
+
+def state_path(crawldir: str) -> str:
+    return os.path.join(crawldir, STATE_FILE)
+
+
+def open_state(path: str) -> sqlite3.Connection:
+    """
+    Opens (and if necessary creates) the state database at the given path.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+
+    create_repositories = """
+    CREATE TABLE IF NOT EXISTS repositories (
+        repo_id UNSIGNED BIG INT PRIMARY KEY,
+        html_url TEXT,
+        newest_sha TEXT,
+        committed_at TEXT,
+        pushed_at TEXT
+    );
+    """
+
+    c = conn.cursor()
+    c.execute(create_repositories)
+    conn.commit()
+    return conn
+
+
+def get_state(conn: sqlite3.Connection, repo_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Returns the recorded state of the repository with the given ID, if there is one.
+    """
+    row = conn.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM repositories WHERE repo_id = ?;",
+        (repo_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(COLUMNS, row))
+
+
+def record_states(conn: sqlite3.Connection, states: Iterable[Tuple[Any, ...]]) -> None:
+    """
+    Records the given (repo_id, html_url, newest_sha, committed_at, pushed_at) states in one
+    transaction. newest_sha and committed_at may be None if no new commits were retrieved.
+    """
+    conn.executemany(upsert_state, states)
+    conn.commit()
@@ -1,5 +1,6 @@
 import re
 import os
+import math
 import csv
 import sys
 import json
@@ -8,21 +9,49 @@ import glob
 import zipfile
 import string
 import traceback
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate
+from functools import partial
 from pathlib import Path
-from typing import Optional
-
-from .utils import flatten_json, get_nearest_value
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from urllib.parse import parse_qs, urlparse
 
 import requests
 import click
 
-from ..settings import GITHUB_TOKEN
-from .utils import write_with_size, read_command_type, request_with_limit
+from . import client
+from .commit_state import get_state, open_state, record_states, state_path
+from .local_commits import clone_path, count_commits, git_log
+from .projection import compile_projector
+from .ranges import get_repos_files, read_repos
+from .tokens import TokenPool, load_tokens
+from .batches import FORMATS
+from .segments import DEFAULT_MAX_SEGMENT_BYTES, SegmentWriter, next_file_index
+from .utils import request_with_limit
 from .data import CommitPublic
 
 
 DATETIME_HEADER = "Date"
 
+# Largest page size the commits API allows
+PER_PAGE = 100
+
+# Number of commits read from a local clone at a time
+LOCAL_PAGE_SIZE = 10000
+
 
 validate_models = {"CommitPublic": CommitPublic}
 
@@ -33,36 +62,20 @@ class MaskStructureError(Exception):
     pass
 
 
-def dump_date(date, file_index, path):
-    file_path = os.path.join(path, f"{file_index}.json")
-
-    with open(file_path, "r", newline="", encoding="utf8") as file:
-        data = json.load(file)
-
-    with open(file_path, "w", newline="", encoding="utf8") as file:
-        data["crawled_at"] = date
-        json.dump(data, file)
-
-
-def create_file(init_json, file_index, path):
-    file_path = os.path.join(path, f"{file_index}.json")
-
-    with open(file_path, "w", encoding="utf8") as file:
-
-        json.dump(init_json, file)
-
-
-def validate(data, allowed_data, schema):
-    """Take a data structure and apply pydentic model."""
-    pydentic_class = validate_models[schema]
-    allowed_data.update(pydentic_class(**data).dict())
+def validate(data, allowed_data, schema, validate_records=True):
+    """
+    Take a data structure (API payload, nested or flattened) and project it onto the fields of the
+    pydentic model, validating them unless validate_records is False.
+    """
+    project = compile_projector(validate_models[schema], validate_records)
+    allowed_data.update(project(data))
 
 
-def commits_parser(github_commits, repo_id, html_url, schema):
+def commits_parser(github_commits, repo_id, html_url, schema, validate_records=True):
 
     """
     Push commits via validator and add additional fileds.
-    return list of json string
+    return sha and commit date of the newest commit and list of json string
     """
     commits = github_commits.json()
 
@@ -73,26 +86,179 @@ def commits_parser(github_commits, repo_id, html_url, schema):
         allowed_data = {"repo_id": repo_id, "repo_html_url": html_url}
 
         if commit:
-            validate(flatten_json(commit), allowed_data, schema)
+            validate(commit, allowed_data, schema, validate_records)
 
         out.append(allowed_data)
 
-    return commits[0]["sha"], out
+    if not commits:
+        return None, None, out
+
+    committed_at = commits[0].get("commit", {}).get("committer", {}).get("date")
+    return commits[0]["sha"], committed_at, out
+
+
+def last_page(response: requests.Response) -> int:
+    """
+    Returns the number of the last page of a paginated response, read from its Link header. If
+    there is no link to a last page, the response is the only (or the last) page.
+    """
+    last_url = response.links.get("last", {}).get("url")
+    if last_url is None:
+        return 1
+    page = parse_qs(urlparse(last_url).query).get("page")
+    if not page:
+        return 1
+    return int(page[0])
+
+
+class CommitsPage(NamedTuple):
+    # SHA and commit date of the first (newest) commit on the page
+    sha: Optional[str]
+    committed_at: Optional[str]
+    commits: List[Dict[str, Any]]
+    # Date header of the response
+    date: Optional[str]
+    last_page: int
+
+
+def fetch_commits(
+    repo: Dict[str, Any],
+    headers: Dict[str, str],
+    min_rate_limit: int,
+    pool: TokenPool,
+    schema: str,
+    params: Optional[Dict[str, Any]] = None,
+    validate_records: bool = True,
+) -> CommitsPage:
+    """
+    Requests (a page of) the commits of the given repository.
+    """
+    commits_responce = request_with_limit(
+        repo["commits_url"].replace("{/sha}", ""),
+        headers,
+        min_rate_limit,
+        pool,
+        params=params,
+    )
+    sha, committed_at, commits = commits_parser(
+        commits_responce, repo["id"], repo["html_url"], schema, validate_records
+    )
+
+    # date of creating that commits file
+    date = commits_responce.headers.get(DATETIME_HEADER)
+    return CommitsPage(sha, committed_at, commits, date, last_page(commits_responce))
+
+
+def until_known(
+    commits: List[Dict[str, Any]], known_sha: Optional[str]
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Cuts the given commits (newest first) at the known commit.
+
+    Returns: Pair of (commits newer than the known commit, whether the known commit was reached)
+    """
+    if known_sha is None:
+        return commits, False
+    for i, commit in enumerate(commits):
+        if commit.get("sha") == known_sha:
+            return commits[:i], True
+    return commits, False
 
 
-def read_repos(repos_dir, file_name, start_id, end_id):
+def extract_local_commits(
+    task: Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]],
+    clones_dir: str,
+    schema: str,
+    max_commits: Optional[int],
+    validate_records: bool = True,
+) -> Optional[CommitsPage]:
     """
-    Read repos from file. Filter repos by given repo id range if specified.
+    Reads the first page of commits of the repository of the given (repos file, repository, state)
+    task from its local clone (see read_local_page).
     """
-    repos_file_path = os.path.join(repos_dir, file_name)
+    _, repo, state = task
+    return read_local_page(
+        (repo, state, 1), clones_dir, schema, max_commits, validate_records
+    )
 
-    # load available repo
-    if os.path.isfile(repos_file_path):
-        with open(repos_file_path, "r") as repos_file:
-            if start_id and end_id:
-                return [repo for repo in json.load(repos_file)["data"] if repo["id"]]
-            else:
-                return json.load(repos_file)["data"]
+
+def read_local_page(
+    task: Tuple[Dict[str, Any], Optional[Dict[str, Any]], int],
+    clones_dir: str,
+    schema: str,
+    max_commits: Optional[int],
+    validate_records: bool = True,
+) -> Optional[CommitsPage]:
+    """
+    Reads the given page of LOCAL_PAGE_SIZE commits of the repository of the given (repository,
+    state, page) task from its local clone, so that long histories are passed back from worker
+    processes a page at a time. Reading stops after the newest commit recorded in the state, if
+    there is one - like pages from the API, the page then ends with the known commit.
+
+    Returns: Page of commits, or None if the repository has not been cloned. The number of pages
+    is only counted for the first page.
+    """
+    repo, state, page = task
+    repo_path = clone_path(clones_dir, repo)
+    if not os.path.isdir(repo_path):
+        return None
+
+    skip = (page - 1) * LOCAL_PAGE_SIZE
+    limit = LOCAL_PAGE_SIZE
+    if max_commits is not None:
+        limit = max(min(limit, max_commits - skip), 0)
+
+    known_sha = state["newest_sha"] if state is not None else None
+    sha = None
+    committed_at = None
+    commits = []
+    reached_known = False
+    if limit > 0:
+        for commit in git_log(repo_path, repo, limit, skip):
+            if sha is None:
+                sha = commit["sha"]
+                committed_at = commit["commit_committer_date"]
+            allowed_data = {"repo_id": repo["id"], "repo_html_url": repo["html_url"]}
+            validate(commit, allowed_data, schema, validate_records)
+            commits.append(allowed_data)
+            if commit["sha"] == known_sha:
+                reached_known = True
+                break
+
+    last_page = 1
+    if page == 1 and not reached_known and len(commits) == LOCAL_PAGE_SIZE:
+        total = count_commits(repo_path)
+        if max_commits is not None:
+            total = min(total, max_commits)
+        last_page = max(math.ceil(total / LOCAL_PAGE_SIZE), 1)
+
+    return CommitsPage(sha, committed_at, commits, formatdate(usegmt=True), last_page)
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def ordered_map(
+    executor: Executor,
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    window: int,
+) -> Iterator[Tuple[T, R]]:
+    """
+    Applies fn to the given items on the executor and yields (item, result) pairs in the order of
+    the items. At most `window` items are submitted ahead of the consumer, so results do not pile
+    up in memory if the consumer is slower than the executor.
+    """
+    pending: Deque[Tuple[T, Future]] = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item)))
+        if len(pending) >= window:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+    while pending:
+        done_item, future = pending.popleft()
+        yield done_item, future.result()
 
 
 def create_zip_file(files_dir):
@@ -112,43 +278,6 @@ def create_zip_file(files_dir):
                 )
 
 
-def get_repos_files(repos_dir, start_id, end_id):
-
-    """
-    Return list of files with repose by given ids range or all files from folder if ids range not set
-
-    In order to make sure that all repositories are covered,
-    add 2 additional files from the beginning of the ordered directory list and from the end
-
-    """
-
-    dir_files = os.listdir(repos_dir)
-
-    if not dir_files:
-        raise ("Empty repos dir.")
-
-    result_command_type = read_command_type(os.path.join(repos_dir, dir_files[0]))
-
-    if start_id and end_id and result_command_type == "crawl":
-
-        nerest_start_id = get_nearest_value(dir_files, start_id)
-
-        if dir_files.index(f"{nerest_start_id}.json") - 2 <= 0:
-            start_index = 0
-        else:
-            start_file = dir_files.index(f"{nerest_start_id}.json") - 2
-
-        nerest_end_id = get_nearest_value(dir_files, end_id)
-
-        if dir_files.index(f"{nerest_end_id}.json") + 2 >= len(dir_files):
-            end_index = -1
-        else:
-            end_index = dir_files.index(f"{nerest_end_id}.json") + 2
-
-    else:
-        return dir_files
-
-
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
 @click.option(
     "--start-id",
@@ -162,7 +291,7 @@ def get_repos_files(repos_dir, start_id, end_id):
     "-e",
     type=int,
     default=None,
-    help="End repo id. You need to specify both parameters start and end id. ",
+    help="End repo id for crawl command output.",
 )
 @click.option("--crawldir", "-d", default=".", help='Path to save folder. default="." ')
 @click.option("--repos-dir", "-r", help="Directory with repos files.")
@@ -176,7 +305,7 @@ def get_repos_files(repos_dir, start_id, end_id):
 @click.option(
     "--token",
     "-t",
-    help="Access token for increase rate limit. Read from env $github_token if specify.",
+    help="Access token or comma-separated tokens for increase rate limit. Read from env if not specified.",
     default=None,
 )
 @click.option(
@@ -186,6 +315,76 @@ def get_repos_files(repos_dir, start_id, end_id):
     default=10,
     help="Minimum remaining rate limit on API under which the crawl is interrupted",
 )
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Directory for cached API responses, revalidated with ETags (default: $MIRROR_HTTP_CACHE_DIR).",
+)
+@click.option(
+    "--cache-max-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Maximum size of the response cache in megabytes.",
+)
+@click.option(
+    "--format",
+    "-f",
+    "output_format",
+    type=click.Choice(list(FORMATS)),
+    default="jsonl",
+    show_default=True,
+    help="Format of commits files. JSON lines files are appended to as commits arrive, json files are written once when complete.",
+)
+@click.option(
+    "--max-file-size",
+    type=int,
+    default=DEFAULT_MAX_SEGMENT_BYTES,
+    show_default=True,
+    help="Size in bytes (uncompressed) after which a new commits file is started.",
+)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of repositories whose commits are requested at the same time (worker processes with --clones-dir).",
+)
+@click.option(
+    "--clones-dir",
+    default=None,
+    help="Directory with clones made by mirror clone. Commits are read from the clones instead of the API.",
+)
+@click.option(
+    "--no-validate",
+    "validate_records",
+    is_flag=True,
+    flag_value=False,
+    default=True,
+    help="Project commits onto the fields of the schema without validating them.",
+)
+@click.option(
+    "--all-pages",
+    is_flag=True,
+    help="Retrieve the full commit history of every repo instead of only its latest commits.",
+)
+@click.option(
+    "--max-commits",
+    type=int,
+    default=None,
+    help="Maximum number of commits to retrieve per repo.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only retrieve commits newer than the ones retrieved by previous incremental runs, skipping repos which were not pushed to since.",
+)
+@click.option(
+    "--state-file",
+    default=None,
+    help="State database of incremental runs (default: commits_state.sqlite in crawldir).",
+)
 def commits(
     start_id: Optional[int],
     end_id: Optional[int],
@@ -194,33 +393,53 @@ def commits(
     schema: str,
     token: Optional[str],
     min_rate_limit: int,
+    cache_dir: Optional[str],
+    cache_max_size: int,
+    output_format: str,
+    max_file_size: int,
+    concurrency: int,
+    all_pages: bool,
+    max_commits: Optional[int],
+    incremental: bool,
+    state_file: Optional[str],
+    clones_dir: Optional[str],
+    validate_records: bool,
 ):
 
     """
-    Read repos json file and upload all commits for that repos one by one.
+    Read repos json file and upload all commits for that repos. With --concurrency above 1, the
+    commits of several repos are requested in parallel and written in the order of the repos.
+
+    With --all-pages, commits are requested 100 per page. Once the first page of a repo tells how
+    many pages there are (Link header), the remaining pages are requested in parallel and written
+    as they arrive, in order.
+
+    With --incremental, the newest commit retrieved for every repo is recorded in a state database.
+    Later runs skip repos whose pushed_at did not change and only request commits since the newest
+    recorded one, paginating until they reach it.
+
+    Commits files are numbered after the files of previous runs into the same crawldir, and
+    id_indexes.csv is appended to.
+
+    With --clones-dir, commits are read from local clones with git log, on a pool of worker
+    processes, and no API requests are made.
     """
 
     if not os.path.exists(crawldir):
         os.makedirs(crawldir)
 
-    if not token:
-        token = GITHUB_TOKEN
+    pool = TokenPool(load_tokens(token), min_rate_limit)
+    client.configure_cache(cache_dir, cache_max_size * 1024 * 1024)
 
     headers = {
         "accept": "application/vnd.github.v3+json",
     }
 
-    if GITHUB_TOKEN is not None:
-        headers["Authorization"] = f"token {token}"
-    else:
+    if not pool.authenticated and clones_dir is None:
         click.echo(f"start with low rate limit")
 
-    file_index = 1
-
     files_for_proccessing = get_repos_files(repos_dir, start_id, end_id)
 
-    start_block = {"command": "commits", "data": [], "crawled_at": None}
-
     # 2 output idexing csv and commits
     commits_path = os.path.join(crawldir, "commits")
 
@@ -229,64 +448,215 @@ def commits(
     if not os.path.exists(commits_path):
         os.makedirs(commits_path)
 
+    commits_writer = SegmentWriter(
+        commits_path,
+        "commits",
+        output_format,
+        max_file_size,
+        first_index=next_file_index(commits_path),
+    )
+
     with click.progressbar(files_for_proccessing) as bar, open(
-        csv_out, mode="wt", encoding="utf8", newline=""
+        csv_out, mode="at", encoding="utf8", newline=""
     ) as output:
 
         fnames = ["file", "commt_hash", "license", "repo_url", "language"]
 
         writer = csv.DictWriter(output, fieldnames=fnames)
-        writer.writeheader()
-
-        for file_name in bar:
-
-            repos = read_repos(repos_dir, file_name, start_id, end_id)
-
-            if not repos:
-                continue
-
-            create_file(start_block, file_index, commits_path)
-
-            for i, repo in enumerate(repos):
-
-                # Get commits
-                commits_responce = request_with_limit(
-                    repo["commits_url"].replace("{/sha}", ""), headers, min_rate_limit
-                )
-
-                sha, commits = commits_parser(
-                    commits_responce, repo["id"], repo["html_url"], schema
-                )
+        if output.tell() == 0:
+            writer.writeheader()
+
+        state_conn = None
+        if incremental:
+            state_conn = open_state(state_file or state_path(crawldir))
+        # States of the repos in the open commits file - recorded once the file is complete, so
+        # that an interrupted run does not skip commits which never made it to disk
+        pending_states: List[Tuple[Any, ...]] = []
+
+        def record_pending_states() -> None:
+            if state_conn is not None and pending_states:
+                record_states(state_conn, pending_states)
+                pending_states.clear()
+
+        def tasks() -> Iterator[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]]:
+            for file_name in bar:
+                repos = read_repos(repos_dir, file_name, start_id, end_id)
+
+                if not repos:
+                    continue
+
+                for repo in repos:
+                    state = None
+                    if state_conn is not None:
+                        state = get_state(state_conn, repo["id"])
+                        pushed_at = repo.get("pushed_at")
+                        if (
+                            state is not None
+                            and pushed_at is not None
+                            and state["pushed_at"] == pushed_at
+                        ):
+                            continue
+                    yield file_name, repo, state
+
+        def page_params(
+            state: Optional[Dict[str, Any]], page: Optional[int] = None
+        ) -> Optional[Dict[str, Any]]:
+            params: Dict[str, Any] = {}
+            # Incremental runs page through all commits since the recorded one
+            if all_pages or (state is not None and state["newest_sha"] is not None):
+                params["per_page"] = PER_PAGE
+            if page is not None:
+                params["page"] = page
+            if state is not None and state["committed_at"] is not None:
+                params["since"] = state["committed_at"]
+            return params or None
+
+        max_pages = None
+        if max_commits is not None:
+            max_pages = max(math.ceil(max_commits / PER_PAGE), 1)
+
+        def fetch(
+            task: Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]
+        ) -> CommitsPage:
+            _, repo, state = task
+            return fetch_commits(
+                repo,
+                headers,
+                min_rate_limit,
+                pool,
+                schema,
+                page_params(state),
+                validate_records,
+            )
+
+        def fetch_page(
+            task: Tuple[Dict[str, Any], Optional[Dict[str, Any]], int]
+        ) -> CommitsPage:
+            repo, state, page = task
+            return fetch_commits(
+                repo,
+                headers,
+                min_rate_limit,
+                pool,
+                schema,
+                page_params(state, page),
+                validate_records,
+            )
+
+        concurrency = max(concurrency, 1)
+        repo_executor: Executor = ThreadPoolExecutor(max_workers=concurrency)
+        page_executor: Executor = ThreadPoolExecutor(max_workers=concurrency)
+        fetch_first_page: Callable[..., Optional[CommitsPage]] = fetch
+        fetch_next_page: Callable[..., Optional[CommitsPage]] = fetch_page
+        if clones_dir is not None:
+            # Local histories are read a page at a time, on the worker processes
+            repo_executor = ProcessPoolExecutor(max_workers=concurrency)
+            page_executor = repo_executor
+            fetch_first_page = partial(
+                extract_local_commits,
+                clones_dir=clones_dir,
+                schema=schema,
+                max_commits=max_commits,
+                validate_records=validate_records,
+            )
+            fetch_next_page = partial(
+                read_local_page,
+                clones_dir=clones_dir,
+                schema=schema,
+                max_commits=max_commits,
+                validate_records=validate_records,
+            )
+        with repo_executor, page_executor:
+            previous_file_name = None
+            for (file_name, repo, state), first_page in ordered_map(
+                repo_executor, fetch_first_page, tasks(), 2 * concurrency
+            ):
+                if first_page is None:
+                    print(
+                        f"No clone of {repo['html_url']} in {clones_dir}",
+                        file=sys.stderr,
+                    )
+                    continue
+
+                # Every repos file starts a new commits file
+                if previous_file_name is not None and file_name != previous_file_name:
+                    commits_writer.rotate()
+                    record_pending_states()
+                previous_file_name = file_name
+
+                known_sha = state["newest_sha"] if state is not None else None
+                commits, reached_known = until_known(first_page.commits, known_sha)
+                remaining = max_commits
+                if remaining is not None:
+                    commits = commits[:remaining]
+                    remaining -= len(commits)
 
                 if repo["license"]:
                     license = repo["license"]["spdx_id"]
                 else:
                     license = repo["license"]
 
-                # date of creating that commits file
-                date = commits_responce.headers.get(DATETIME_HEADER)
-
-                # Indexing
-                writer.writerow(
-                    {
-                        "file": os.path.join("commits", f"{file_index}.json"),
-                        "repo_url": repo["html_url"],
-                        "commt_hash": sha,
-                        "license": license,
-                        "language": repo["language"],
-                    }
-                )
-
-                current_size = write_with_size(commits, file_index, commits_path)
-
-                # Size regulation
-                if current_size > 5000000:
-                    dump_date(date, file_index, commits_path)
-                    file_index += 1
-                    create_file(start_block, file_index, commits_path)
-                elif i == len(repos) - 1:
-                    dump_date(date, file_index, commits_path)
-                    file_index += 1
+                # Incremental runs only index repos with new commits
+                if commits or not incremental:
+                    # Indexing
+                    writer.writerow(
+                        {
+                            "file": os.path.join("commits", commits_writer.file_name),
+                            "repo_url": repo["html_url"],
+                            "commt_hash": first_page.sha,
+                            "license": license,
+                            "language": repo["language"],
+                        }
+                    )
+
+                # Commits of a repo are never split over two files - size regulation
+                # happens once all of its pages have been written
+                commits_writer.write(commits, first_page.date, rotate=False)
+
+                pages = first_page.last_page
+                if (
+                    (all_pages or known_sha is not None or clones_dir is not None)
+                    and pages > 1
+                    and not reached_known
+                    and (remaining is None or remaining > 0)
+                ):
+                    if max_pages is not None and clones_dir is None:
+                        pages = min(pages, max_pages)
+                    page_tasks = [(repo, state, page) for page in range(2, pages + 1)]
+                    for _, page in ordered_map(
+                        page_executor, fetch_next_page, page_tasks, 2 * concurrency
+                    ):
+                        if page is None:
+                            break
+                        page_commits, reached_known = until_known(
+                            page.commits, known_sha
+                        )
+                        if remaining is not None:
+                            page_commits = page_commits[:remaining]
+                            remaining -= len(page_commits)
+                        commits_writer.write(page_commits, page.date, rotate=False)
+                        if reached_known or remaining == 0:
+                            break
+
+                if state_conn is not None:
+                    pending_states.append(
+                        (
+                            repo["id"],
+                            repo["html_url"],
+                            first_page.sha if commits else None,
+                            first_page.committed_at if commits else None,
+                            repo.get("pushed_at"),
+                        )
+                    )
+
+                segment_index = commits_writer.index
+                commits_writer.rotate_if_full()
+                if commits_writer.index != segment_index:
+                    record_pending_states()
+    commits_writer.close()
+    record_pending_states()
+    if state_conn is not None:
+        state_conn.close()
     create_zip_file(commits_path)
 
 
@@ -4,13 +4,15 @@ from datetime import datetime
 import json
 import os
 from pathlib import Path
+import subprocess
 import sys
-from typing import Dict, Optional, Union
+from typing import Dict, Optional, Set, Union
 import zipfile
 
 import click
 
 from . import db_tool
+from .catalog import latest_clones, open_catalog
 from .. import settings
 
 
@@ -32,12 +34,17 @@ class ChunkLoader:
         batch_size,
         common_path,
         max_file_bytes: int = 1 * 1024 * 1024,
+        skip_files: Optional[Set[str]] = None,
     ):
         self.line_index = 0
         self.file_index = 0
         self.chunk_size = chunksize
         self.rows_step = rows_step
-        self.files = list_all_files(repo_path)
+        self.files = [
+            file_path
+            for file_path in list_all_files(repo_path)
+            if not skip_files or os.path.abspath(file_path) not in skip_files
+        ]
         self.batch_size = batch_size
         self.common_path = common_path
         self.extension_language_dict = extension_language_dict
@@ -171,6 +178,29 @@ def list_all_files(directory):
     return file_list
 
 
+def repo_blobs(repo_path) -> Dict[str, str]:
+    """
+    Returns the git blob hash of every file in the index of the clone at the given path, by
+    absolute file path. Returns an empty dictionary if the path is not a git repository.
+    """
+    result = subprocess.run(
+        ["git", "ls-files", "--stage", "-z"],
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        return {}
+
+    blobs = {}
+    for record in result.stdout.decode("utf8", errors="replace").split("\0"):
+        if not record:
+            continue
+        info, file_path = record.split("\t", 1)
+        blobs[os.path.abspath(os.path.join(repo_path, file_path))] = info.split()[1]
+    return blobs
+
+
 def chunk_encode(iterable_lines):
     return base64.b64encode("".join(iterable_lines).encode("utf8")).decode("utf8")
 
@@ -205,6 +235,21 @@ def chunk_encode(iterable_lines):
     default=None,
     help="Path to json file with languages for extracting.",
 )
+@click.option("--owner", default=None, help="Only use the repos of this owner.")
+@click.option(
+    "--language",
+    "repo_language",
+    default=None,
+    help="Only use the repos cloned for this language.",
+)
+@click.option(
+    "--commit-hash", default=None, help="Only use the repo cloned at this commit."
+)
+@click.option(
+    "--skip-shared-blobs",
+    is_flag=True,
+    help="Skip files whose content (git blob) was already chunked from another repo, such as the files forks share with their source.",
+)
 def generate_datasets(
     crawldir: str,
     clone_dir: Optional[str],
@@ -212,10 +257,19 @@ def generate_datasets(
     batch_size: int,
     rows_step: Optional[int],
     languages_file: str,
+    owner: Optional[str],
+    repo_language: Optional[str],
+    commit_hash: Optional[str],
+    skip_shared_blobs: bool,
 ):
 
     """
     Create snippets dataset from cloned repos
+
+    Repos are looked up in the catalog of the clone dir (see catalog.py), optionally by owner,
+    language or commit hash.
+
+    With --skip-shared-blobs, a file is only chunked for the first repo which has its content.
     """
 
     if not rows_step:
@@ -262,31 +316,28 @@ def generate_datasets(
 
     crawled_repos: Dict[str, Dict[str, Union[str, None]]] = {}
 
-    # This take a lot of processing vs very simple os.walk().next()[1]
-    all_organization = [
-        folder
-        for folder in os.listdir(clone_dir)
-        if os.path.isdir(os.path.join(clone_dir, folder))
-    ]
-
-    for organization in all_organization:
-        organization_path = os.path.join(clone_dir, organization)
-
-        meta_path = os.path.join(organization_path, "meta.json")
-
-        if not os.path.exists(meta_path):
-            continue
-
-        with open(meta_path, "r") as repos_meta_file:
-            repos_meta = json.load(repos_meta_file)
+    catalog_conn = open_catalog(clone_dir)
+    for repo_owner, _, repo in latest_clones(
+        catalog_conn, owner, repo_language, commit_hash
+    ):
+        crawled_repos[os.path.join(clone_dir, repo_owner, repo["name"])] = repo
+    catalog_conn.close()
 
-        for repo in repos_meta["repos"]:
-            crawled_repos[os.path.join(organization_path, repo["name"])] = repo
+    # Blob hashes of the files chunked so far
+    seen_blobs: Set[str] = set()
 
     for repo_path, repo in crawled_repos.items():
         license = None
         print(repo["name"])
 
+        skip_files: Set[str] = set()
+        if skip_shared_blobs:
+            blobs = repo_blobs(repo_path)
+            skip_files = {
+                file_path for file_path, blob in blobs.items() if blob in seen_blobs
+            }
+            seen_blobs.update(blobs.values())
+
         loader = ChunkLoader(
             repo_path,
             extension_to_language,
@@ -294,6 +345,7 @@ def generate_datasets(
             rows_step,
             batch_size,
             clone_dir,
+            skip_files=skip_files,
         )
 
         if repo["license"]:
@@ -8,15 +8,20 @@ import os
 import sys
 import click
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-import requests
 from tqdm import tqdm  # type: ignore
 
+from . import client
+from .tokens import TokenPool, default_pool, load_tokens
+from .utils import request_with_limit
+
 subcommand = "licenses"
 
 
-def get_license(repo_api_url: str) -> Dict[str, Any]:
+def get_license(
+    repo_api_url: str, pool: Optional[TokenPool] = None
+) -> Optional[Dict[str, Any]]:
     """
     Gets the license for the repository at the given GitHub API URL.
 
@@ -25,32 +30,34 @@ def get_license(repo_api_url: str) -> Dict[str, Any]:
         GitHub API URL for a repository. These are of the form:
         https://api.github.com/repos/:owner/:name
         This URL is allowed to have a trailing slash.
+    pool
+        Tokens to make requests with (default: tokens configured in the environment)
 
     Returns: JSON-serializable dictionary of the form:
     {'ending_rate_limit': <rate limit after the query>, 'data': <license info>}
+    The rate limit is the largest one remaining over all tokens in the pool. Requests which are
+    rejected because of the rate limit are retried with another token (see
+    utils.request_with_limit). None is returned if GitHub answers with an error other than 404
+    (the repository has no license).
     """
     headers = {
         "Accept": "application/vnd.github.v3+json",
         "User-Agent": "simiotics mirror",
     }
-    github_token = os.environ.get("GITHUB_TOKEN")
-    if github_token is not None and github_token != "":
-        headers["Authorization"] = f"token {github_token}"
+    if pool is None:
+        pool = default_pool()
 
     if repo_api_url[-1] == "/":
         repo_api_url = repo_api_url[:-1]
 
     license_url = f"{repo_api_url}/license"
 
-    r = requests.get(license_url, headers)
-    ending_rate_limit_raw = r.headers.get("X-RateLimit-Remaining", "")
-    try:
-        ending_rate_limit = int(ending_rate_limit_raw)
-    except:
-        ending_rate_limit = -1
+    r = request_with_limit(license_url, headers, pool.min_rate_limit, pool)
+    if r.status_code not in (200, 404):
+        return None
 
     result: Dict[str, Any] = {
-        "ending_rate_limit": ending_rate_limit,
+        "ending_rate_limit": pool.remaining(),
         "data": r.json(),
     }
     return result
@@ -65,6 +72,7 @@ def get_license(repo_api_url: str) -> Dict[str, Any]:
 @click.option(
     "--repos",
     "-r",
+    "repos_json",
     help='File with JSON array of GitHub API URLs for repos (if value is "file:<filename>") '
     "OR comma-separated list of GitHub API URLs of repos",
 )
@@ -82,14 +90,37 @@ def get_license(repo_api_url: str) -> Dict[str, Any]:
     default=30,
     help="Minimum remaining rate limit on API under which the crawl is interrupted",
 )
+@click.option(
+    "--token",
+    help="Access token or comma-separated tokens for increase rate limit. Read from env if not specified.",
+    default=None,
+)
 @click.option(
     "--outfile",
     "-o",
-    default=30,
+    default=None,
     help="File to which to write license information as JSON lines, one per repository",
 )
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Directory for cached API responses, revalidated with ETags (default: $MIRROR_HTTP_CACHE_DIR).",
+)
+@click.option(
+    "--cache-max-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Maximum size of the response cache in megabytes.",
+)
 def licenses_handler(
-    repos_json: str, interval: float, min_rate_limit: int, outfile: str
+    repos_json: str,
+    interval: float,
+    min_rate_limit: int,
+    token: Optional[str],
+    outfile: str,
+    cache_dir: Optional[str],
+    cache_max_size: int,
 ) -> None:
     """
     Handler for licenses subcommand
@@ -100,8 +131,12 @@ def licenses_handler(
         the command line
 
     Returns: None, prints license information for the repositories in args.repos to stdout or to the
-    file specified by args.outfile
+    file specified by args.outfile. Stops once every token in the pool reached the minimum rate
+    limit. Repositories for which GitHub answers with an error are reported on stderr and skipped.
     """
+    pool = TokenPool(load_tokens(token), min_rate_limit)
+    client.configure_cache(cache_dir, cache_max_size * 1024 * 1024)
+
     repos: List[str] = []
     if repos_json[: len("file:")] == "file:":
         infile = repos_json[len("file:") :]
@@ -116,9 +151,12 @@ def licenses_handler(
 
     for repo in repos:
         time.sleep(interval)
-        result = get_license(repo)
-        print(json.dumps(result), file=ofp)
-        if result["ending_rate_limit"] < min_rate_limit:
+        result = get_license(repo, pool)
+        if result is None:
+            print(f"Could not get license of {repo}", file=sys.stderr)
+        else:
+            print(json.dumps(result), file=ofp)
+        if pool.exhausted():
             break
 
     if outfile is not None:
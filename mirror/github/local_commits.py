@@ -0,0 +1,131 @@
+"""
+Commit history extraction from local clones (as written by "mirror clone").
+
+The history of a clone is read with "git log" processes whose output is streamed and parsed commit
+by commit. Long histories are read in pages (see git_log and count_commits), so that no worker
+ever holds the whole history of a repository. Commits are returned in the flattened layout of commits from the GitHub REST API
+(see utils.flatten_json), so that they can be validated against the same schemas as commits
+retrieved from the API.
+"""
+
+import os
+import subprocess
+from typing import Any, Dict, Iterator, Optional
+
+# Fields are separated by the unit separator and commits by NUL bytes (git log -z). The message
+# comes last, so that it may contain anything but a NUL byte.
+FIELD_SEPARATOR = "\x1f"
+LOG_FIELDS = [
+    ("sha", "%H"),
+    ("commit_author_name", "%an"),
+    ("commit_author_email", "%ae"),
+    ("commit_author_date", "%aI"),
+    ("commit_committer_name", "%cn"),
+    ("commit_committer_email", "%ce"),
+    ("commit_committer_date", "%cI"),
+    ("commit_message", "%B"),
+]
+LOG_FORMAT = "%x1f".join(placeholder for _, placeholder in LOG_FIELDS)
+
+API_URL = "https://api.github.com"
+
+
+def clone_path(clones_dir: str, repo: Dict[str, Any]) -> str:
+    """
+    Returns the path of the clone of the given repository in the layout of "mirror clone":
+    <clones_dir>/<owner>/<name>
+    """
+    return os.path.join(clones_dir, repo["owner"]["login"], repo["name"])
+
+
+def read_records(stream: Iterator[str], separator: str) -> Iterator[str]:
+    """
+    Splits a text stream into separator-terminated records without reading all of it at once.
+    """
+    buffer = ""
+    for chunk in stream:
+        buffer += chunk
+        *records, buffer = buffer.split(separator)
+        yield from records
+    if buffer:
+        yield buffer
+
+
+def count_commits(repo_path: str) -> int:
+    """
+    Returns the number of commits reachable from HEAD of the clone at the given path.
+    """
+    result = subprocess.run(
+        ["git", "rev-list", "--count", "HEAD"],
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding="utf8",
+    )
+    if result.returncode != 0:
+        return 0
+    return int(result.stdout.strip() or 0)
+
+
+def git_log(
+    repo_path: str,
+    repo: Dict[str, Any],
+    max_commits: Optional[int] = None,
+    skip: int = 0,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the commits reachable from HEAD of the clone at the given path, newest first, as
+    flattened GitHub API commits. URLs which GitHub would return are built from the full name and
+    HTML URL of the repository. The GitHub accounts of authors and committers are not known
+    locally, so their URLs are not set.
+
+    Args:
+    repo_path
+        Path to the clone
+    repo
+        Repository metadata, as crawled from the GitHub API
+    max_commits
+        Maximum number of commits to read (default: all)
+    skip
+        Number of newest commits to skip before reading
+
+    Returns: Iterator over commits. Stopping the iteration early terminates the git process.
+    """
+    args = ["git", "log", "-z", f"--format={LOG_FORMAT}"]
+    if max_commits is not None:
+        args.append(f"--max-count={max_commits}")
+    if skip:
+        args.append(f"--skip={skip}")
+    args.append("HEAD")
+
+    process = subprocess.Popen(
+        args,
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        encoding="utf8",
+        errors="replace",
+    )
+    assert process.stdout is not None
+    try:
+        stream = iter(lambda: process.stdout.read(64 * 1024), "")  # type: ignore
+        for record in read_records(stream, "\0"):
+            values = record.split(FIELD_SEPARATOR, len(LOG_FIELDS) - 1)
+            if len(values) != len(LOG_FIELDS):
+                continue
+            commit: Dict[str, Any] = {
+                name: value for (name, _), value in zip(LOG_FIELDS, values)
+            }
+            sha = commit["sha"]
+            commit["commit_url"] = (
+                f"{API_URL}/repos/{repo['full_name']}/git/commits/{sha}"
+            )
+            commit["html_url"] = f"{repo['html_url']}/commit/{sha}"
+            commit["author_html_url"] = None
+            commit["committer_html_url"] = None
+            yield commit
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
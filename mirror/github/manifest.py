@@ -0,0 +1,191 @@
+"""
+Manifest of the batch files in an allrepos crawl directory.
+
+The manifest is a SQLite database (manifest.sqlite) inside the crawl directory with one row per
+batch file: its start ID, first and last repository ID, number of repositories, size in bytes and
+checksum. The crawler adds a row for every batch it writes, so nextid, validate and sample can look
+batches up in the manifest instead of globbing and parsing the whole crawl directory. If batch
+files are added or removed by other means, the manifest can be rebuilt with "mirror reindex".
+"""
+
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+from .batches import batch_summary, list_batches
+
+MANIFEST_FILE = "manifest.sqlite"
+
+COLUMNS = ["file", "start_id", "first_id", "last_id", "count", "size", "checksum"]
+
+insert_batch = f"""
+INSERT OR REPLACE INTO batches({", ".join(COLUMNS)})
+VALUES ({", ".join(["?"] * len(COLUMNS))});
+"""
+
+
+def manifest_path(crawldir: str) -> str:
+    return os.path.join(crawldir, MANIFEST_FILE)
+
+
+def has_manifest(crawldir: str) -> bool:
+    return os.path.exists(manifest_path(crawldir))
+
+
+def open_manifest(crawldir: str) -> sqlite3.Connection:
+    """
+    Opens (and if necessary creates) the manifest of the given crawl directory.
+    """
+    conn = sqlite3.connect(manifest_path(crawldir), timeout=60)
+
+    create_batches = """
+    CREATE TABLE IF NOT EXISTS batches (
+        file TEXT PRIMARY KEY,
+        start_id UNSIGNED BIG INT NOT NULL,
+        first_id UNSIGNED BIG INT,
+        last_id UNSIGNED BIG INT,
+        count INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        checksum TEXT NOT NULL
+    );
+    """
+    create_start_id_index = (
+        "CREATE INDEX IF NOT EXISTS batches_start_id ON batches(start_id);"
+    )
+
+    c = conn.cursor()
+    c.execute(create_batches)
+    c.execute(create_start_id_index)
+    conn.commit()
+    return conn
+
+
+def checksum(path: str) -> str:
+    """
+    Returns the SHA256 hex digest of the given file.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as ifp:
+        for chunk in iter(lambda: ifp.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def describe_batch(
+    path: str, summary: Optional[Dict[str, Any]] = None
+) -> Tuple[Any, ...]:
+    """
+    Returns the manifest row for the given batch file. If the summary of the batch (start, first
+    and last ID and count) is already known, the batch does not have to be parsed again.
+    """
+    if summary is None:
+        summary = batch_summary(path)
+    return (
+        os.path.basename(path),
+        summary["start_id"],
+        summary["first_id"],
+        summary["last_id"],
+        summary["count"],
+        os.path.getsize(path),
+        checksum(path),
+    )
+
+
+def record_batch(
+    crawldir: str, path: str, summary: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Adds the given batch file to the manifest of the crawl directory.
+    """
+    row = describe_batch(path, summary)
+    conn = open_manifest(crawldir)
+    try:
+        conn.execute(insert_batch, row)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def forget_batch(crawldir: str, path: str) -> None:
+    """
+    Removes the given batch file from the manifest of the crawl directory.
+    """
+    conn = open_manifest(crawldir)
+    try:
+        conn.execute("DELETE FROM batches WHERE file = ?;", (os.path.basename(path),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def reindex(crawldir: str, num_processes: int = 1) -> int:
+    """
+    Rebuilds the manifest of the given crawl directory from the batch files in it.
+
+    Returns: Number of batch files indexed
+    """
+    result_files = list_batches(crawldir)
+    if num_processes > 1 and len(result_files) > 1:
+        with multiprocessing.Pool(num_processes) as worker_pool:
+            rows = worker_pool.map(describe_batch, result_files, chunksize=64)
+    else:
+        rows = [describe_batch(result_file) for result_file in result_files]
+
+    conn = open_manifest(crawldir)
+    try:
+        conn.execute("DELETE FROM batches;")
+        conn.executemany(insert_batch, rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def entries(
+    crawldir: str, from_id: Optional[int] = None, to_id: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Returns the manifest rows of the crawl directory ordered by start ID, optionally restricted to
+    the batches whose start ID lies in [from_id, to_id].
+    """
+    selector = f"SELECT {', '.join(COLUMNS)} FROM batches"
+    conditions = []
+    parameters = []
+    if from_id is not None:
+        conditions.append("start_id >= ?")
+        parameters.append(from_id)
+    if to_id is not None:
+        conditions.append("start_id <= ?")
+        parameters.append(to_id)
+    if conditions:
+        selector += " WHERE " + " AND ".join(conditions)
+    selector += " ORDER BY start_id ASC;"
+
+    conn = open_manifest(crawldir)
+    try:
+        rows = conn.execute(selector, parameters).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {**dict(zip(COLUMNS, row)), "path": os.path.join(crawldir, row[0])}
+        for row in rows
+    ]
+
+
+def last_entry(crawldir: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the manifest row of the batch with the largest start ID, if there is one.
+    """
+    conn = open_manifest(crawldir)
+    try:
+        row = conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM batches ORDER BY start_id DESC LIMIT 1;"
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return dict(zip(COLUMNS, row))
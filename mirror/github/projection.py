@@ -0,0 +1,233 @@
+"""
+Schema-driven projection of GitHub API payloads onto the fields of a pydantic schema.
+
+The schemas in commits.validate_models are defined over the flattened layout of API payloads (see
+utils.flatten_json): the field "author_html_url" holds payload["author"]["html_url"]. Instead of
+flattening every payload completely - including nested parents, verification data and the like -
+and handing the result to the schema, a projector is compiled once per schema. It knows, for every
+field, which nested paths can produce that flattened name and looks up only those.
+
+Run this module to benchmark projection against flatten_json + validation:
+    python -m mirror.github.projection --records 20000
+"""
+
+import time
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Type
+
+import click
+from pydantic import BaseModel
+
+from .utils import flatten_json
+
+Path = Tuple[Any, ...]
+Projector = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+_MISSING = object()
+
+_projectors: Dict[Tuple[Type[BaseModel], bool], Projector] = {}
+
+
+def schema_fields(schema: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Returns the default value of every field of the given schema (pydantic 1 and 2).
+    """
+    fields = getattr(schema, "model_fields", None)
+    if fields is None:
+        fields = getattr(schema, "__fields__")
+    return {name: field.default for name, field in fields.items()}
+
+
+def candidate_paths(name: str) -> List[Path]:
+    """
+    Returns every nested path whose flattened name (as produced by flatten_json) is the given name.
+    Keys may themselves contain underscores, so "author_html_url" could come from
+    ["author_html_url"], ["author", "html_url"], ["author_html", "url"] or
+    ["author", "html", "url"]. Numeric parts may also index lists.
+
+    Paths with fewer (longer) keys come first.
+    """
+    parts = name.split("_")
+    paths: List[List[str]] = []
+    for mask in range(2 ** (len(parts) - 1)):
+        path = [parts[0]]
+        for i, part in enumerate(parts[1:]):
+            if mask & (1 << i):
+                path.append(part)
+            else:
+                path[-1] = f"{path[-1]}_{part}"
+        paths.append(path)
+    paths.sort(key=len)
+    return [tuple(int(key) if key.isdigit() else key for key in path) for path in paths]
+
+
+def resolve(data: Any, path: Path) -> Any:
+    """
+    Returns the leaf value at the given path in the payload, or _MISSING if there is none.
+    """
+    for key in path:
+        if isinstance(key, int):
+            if type(data) is list and key < len(data):
+                data = data[key]
+                continue
+            key = str(key)
+        if type(data) is not dict:
+            return _MISSING
+        data = data.get(key, _MISSING)
+        if data is _MISSING:
+            return _MISSING
+    if type(data) is dict or type(data) is list:
+        return _MISSING
+    return data
+
+
+def compile_projector(schema: Type[BaseModel], validate: bool = True) -> Projector:
+    """
+    Returns a function which projects an API payload onto the fields of the given schema. Projectors
+    are compiled once per schema and cached.
+
+    Args:
+    schema
+        pydantic model whose fields are flattened payload names
+    validate
+        If True, the projected fields are validated with the schema. If False, they are returned
+        as they are (fields missing from the payload take their default value).
+
+    Returns: Projector function
+    """
+    key = (schema, validate)
+    if key in _projectors:
+        return _projectors[key]
+
+    fields: Sequence[Tuple[str, Any, List[Path]]] = [
+        (name, default, candidate_paths(name))
+        for name, default in schema_fields(schema).items()
+    ]
+
+    def project(payload: Dict[str, Any]) -> Dict[str, Any]:
+        projected: Dict[str, Any] = {}
+        for name, default, paths in fields:
+            for path in paths:
+                value = resolve(payload, path)
+                if value is not _MISSING:
+                    projected[name] = value
+                    break
+            else:
+                if not validate:
+                    projected[name] = default
+        if validate:
+            return schema(**projected).dict()
+        return projected
+
+    _projectors[key] = project
+    return project
+
+
+def sample_commit(i: int) -> Dict[str, Any]:
+    """
+    Returns a payload with the structure of an item of the GitHub commits API.
+    """
+    sha = f"{i:040x}"
+    user = {
+        "login": "octocat",
+        "id": 1,
+        "node_id": "MDQ6VXNlcjE=",
+        "avatar_url": "https://github.com/images/error/octocat_happy.gif",
+        "gravatar_id": "",
+        "url": "https://api.github.com/users/octocat",
+        "html_url": "https://github.com/octocat",
+        "followers_url": "https://api.github.com/users/octocat/followers",
+        "repos_url": "https://api.github.com/users/octocat/repos",
+        "type": "User",
+        "site_admin": False,
+    }
+    signature = {
+        "name": "Monalisa Octocat",
+        "email": "support@github.com",
+        "date": "2011-04-14T16:00:49Z",
+    }
+    return {
+        "url": f"https://api.github.com/repos/octocat/Hello-World/commits/{sha}",
+        "sha": sha,
+        "node_id": "MDY6Q29tbWl0NmRjYjA5YjViNTc4NzVmMzM0ZjYxYWViZWQ2OTVlMmU0MTkzZGI1ZQ==",
+        "html_url": f"https://github.com/octocat/Hello-World/commit/{sha}",
+        "comments_url": f"https://api.github.com/repos/octocat/Hello-World/commits/{sha}/comments",
+        "commit": {
+            "url": f"https://api.github.com/repos/octocat/Hello-World/git/commits/{sha}",
+            "author": dict(signature),
+            "committer": dict(signature),
+            "message": "Fix all the bugs",
+            "tree": {
+                "url": f"https://api.github.com/repos/octocat/Hello-World/tree/{sha}",
+                "sha": sha,
+            },
+            "comment_count": 0,
+            "verification": {
+                "verified": False,
+                "reason": "unsigned",
+                "signature": None,
+                "payload": None,
+            },
+        },
+        "author": dict(user),
+        "committer": dict(user),
+        "parents": [
+            {
+                "url": f"https://api.github.com/repos/octocat/Hello-World/commits/{sha}",
+                "sha": sha,
+            }
+        ],
+    }
+
+
+def records_per_second(fn: Callable[[], Any], records: int) -> float:
+    started = time.perf_counter()
+    fn()
+    return records / (time.perf_counter() - started)
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option(
+    "--records",
+    "-n",
+    type=int,
+    default=20000,
+    show_default=True,
+    help="Number of commits to project.",
+)
+@click.option(
+    "--schema",
+    "-S",
+    default="CommitPublic",
+    show_default=True,
+    help="Schema (from mirror.github.commits) to project onto.",
+)
+def benchmark(records: int, schema: str) -> None:
+    """
+    Measures records/sec of flatten_json + validation against compiled projection (with and
+    without validation) on synthetic commits payloads.
+    """
+    from .commits import validate_models
+
+    model = validate_models[schema]
+    payloads = [sample_commit(i) for i in range(records)]
+
+    validated = compile_projector(model)
+    unvalidated = compile_projector(model, validate=False)
+    reference = [model(**flatten_json(payload)).dict() for payload in payloads[:100]]
+    assert reference == [validated(payload) for payload in payloads[:100]]
+    assert reference == [unvalidated(payload) for payload in payloads[:100]]
+
+    results = [
+        (
+            "flatten_json + validation",
+            lambda: [model(**flatten_json(payload)).dict() for payload in payloads],
+        ),
+        ("projection + validation", lambda: [validated(p) for p in payloads]),
+        ("projection", lambda: [unvalidated(p) for p in payloads]),
+    ]
+    for label, fn in results:
+        print(f"{label:<28}{records_per_second(fn, records):>14,.0f} records/sec")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,152 @@
+"""
+Repository ID range index over a directory of repository metadata files (the output of crawl or
+search), used by commits and clone to select repositories by --start-id/--end-id.
+
+The index lists the smallest and largest repository ID in every file. It is stored beside the data
+in a dotfile (.mirror_ranges.json) and kept up to date by re-reading only the files which were
+added or changed since it was written. Crawl directories with a manifest (see manifest.py) already
+record the ID range of every batch, so the manifest is used for them instead.
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from .batches import iter_repositories
+from .manifest import MANIFEST_FILE, entries, has_manifest
+
+RANGES_FILE = ".mirror_ranges.json"
+
+# Files in repos directories which do not hold repositories
+NON_REPOS_FILES = ("languages_config.json", MANIFEST_FILE)
+
+
+def list_repos_files(repos_dir: str) -> List[str]:
+    """
+    Returns the names of the repository metadata files in the given directory, in numeric order
+    of their names (crawl and search results are named <number>.<extension>). Dotfiles (such as
+    the range index itself) are skipped.
+    """
+    dir_files = [
+        filename
+        for filename in os.listdir(repos_dir)
+        if not filename.startswith(".")
+        and filename not in NON_REPOS_FILES
+        and os.path.isfile(os.path.join(repos_dir, filename))
+    ]
+
+    def file_order(filename: str) -> Tuple[int, int, str]:
+        number = filename.split(".")[0]
+        if number.isdigit():
+            return (0, int(number), filename)
+        return (1, 0, filename)
+
+    return sorted(dir_files, key=file_order)
+
+
+def describe_file(repos_dir: str, file_name: str) -> Dict[str, Any]:
+    """
+    Returns the range index entry for the given repository metadata file.
+    """
+    path = os.path.join(repos_dir, file_name)
+    stat = os.stat(path)
+    ids = [repo["id"] for repo in iter_repositories(path) if "id" in repo]
+    return {
+        "file": file_name,
+        "min_id": min(ids) if ids else None,
+        "max_id": max(ids) if ids else None,
+        "count": len(ids),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def build_range_index(repos_dir: str) -> List[Dict[str, Any]]:
+    """
+    Returns the range index of the given repos directory, ordered by smallest ID. The persisted
+    index is reused for files whose size and modification time have not changed; other files are
+    (re)read and the updated index is written back.
+    """
+    index_path = os.path.join(repos_dir, RANGES_FILE)
+    previous: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r") as ifp:
+                previous = {entry["file"]: entry for entry in json.load(ifp)["files"]}
+        except (ValueError, KeyError):
+            previous = {}
+
+    index = []
+    changed = False
+    for file_name in list_repos_files(repos_dir):
+        entry = previous.get(file_name)
+        stat = os.stat(os.path.join(repos_dir, file_name))
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime
+        ):
+            entry = describe_file(repos_dir, file_name)
+            changed = True
+        index.append(entry)
+    changed = changed or len(index) != len(previous)
+
+    index.sort(
+        key=lambda entry: (entry["min_id"] is None, entry["min_id"] or 0, entry["file"])
+    )
+    if changed:
+        with open(index_path, "w") as ofp:
+            json.dump({"files": index}, ofp)
+    return index
+
+
+def get_repos_files(
+    repos_dir: str, start_id: Optional[int], end_id: Optional[int]
+) -> List[str]:
+    """
+    Returns the repository metadata files in the given directory which may hold repositories with
+    IDs in [start_id, end_id]. Either bound may be None. If neither is set, all files are returned.
+    """
+    if start_id is None and end_id is None:
+        dir_files = list_repos_files(repos_dir)
+        if not dir_files:
+            raise ValueError(f"Empty repos dir: {repos_dir}")
+        return dir_files
+
+    if has_manifest(repos_dir):
+        index = [
+            {
+                "file": entry["file"],
+                "min_id": entry["first_id"],
+                "max_id": entry["last_id"],
+            }
+            for entry in entries(repos_dir)
+        ]
+    else:
+        index = build_range_index(repos_dir)
+
+    return [
+        entry["file"]
+        for entry in index
+        if entry["min_id"] is not None
+        and (end_id is None or entry["min_id"] <= end_id)
+        and (start_id is None or entry["max_id"] >= start_id)
+    ]
+
+
+def read_repos(
+    repos_dir: str, file_name: str, start_id: Optional[int], end_id: Optional[int]
+) -> List[Dict[str, Any]]:
+    """
+    Read repos from file. Filter repos by given repo id range if specified.
+    """
+    repos_file_path = os.path.join(repos_dir, file_name)
+    if not os.path.isfile(repos_file_path):
+        return []
+
+    return [
+        repo
+        for repo in iter_repositories(repos_file_path)
+        if (start_id is None or repo["id"] >= start_id)
+        and (end_id is None or repo["id"] <= end_id)
+    ]
@@ -0,0 +1,244 @@
+"""
+Fixed-size and stratified random samples of the repositories in an allrepos crawl.
+
+A sample of exactly K repositories is drawn uniformly without replacement, either from the whole
+crawl or proportionally from a number of strata - contiguous groups of batch files covering equal
+widths of the GitHub ID space.
+
+If the number of repositories in every batch file is known (from the crawl manifest), the sample
+positions are drawn up front and only the batch files that contain one of them are read. Otherwise
+each worker process keeps a reservoir per stratum over its share of the batch files - every
+repository gets a uniform random key and a reservoir holds the K smallest keys it has seen - and the
+reservoirs are merged by taking the smallest keys over all workers. Reservoirs only hold the
+location (batch file and position) of each repository, and the sampled repositories are read back
+from their batch files once the reservoirs are merged.
+"""
+
+import bisect
+import heapq
+import multiprocessing
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from .batches import iter_repositories
+
+# (path to batch file, start ID of batch, number of repositories in batch if known)
+Batch = Tuple[str, int, Optional[int]]
+
+# Reservoir of (random key, path to batch file, position in batch file) triples
+Reservoir = List[Tuple[float, str, int]]
+
+
+def assign_strata(batches: List[Batch], strata: int) -> List[int]:
+    """
+    Splits the ID range covered by the given batches into the given number of equal-width strata
+    and returns the index of the stratum of each batch (by its start ID).
+    """
+    if strata <= 1 or not batches:
+        return [0] * len(batches)
+    low = min(batch[1] for batch in batches)
+    high = max(batch[1] for batch in batches) + 1
+    width = (high - low) / strata
+    bounds = [low + width * i for i in range(1, strata)]
+    return [bisect.bisect_right(bounds, batch[1]) for batch in batches]
+
+
+def allocate(size: int, totals: List[int]) -> List[int]:
+    """
+    Allocates a sample of the given size proportionally to the given stratum totals (largest
+    remainder method). No stratum is allocated more than its total.
+    """
+    population = sum(totals)
+    if population <= size:
+        return list(totals)
+    quotas = [size * total / population for total in totals]
+    allocation = [int(quota) for quota in quotas]
+    remainders = sorted(
+        range(len(totals)), key=lambda i: quotas[i] - allocation[i], reverse=True
+    )
+    for i in remainders[: size - sum(allocation)]:
+        allocation[i] += 1
+    return allocation
+
+
+def pick(task: Tuple[str, List[int]]) -> List[Dict[str, Any]]:
+    """
+    Returns the repositories at the given (sorted) positions of the given batch file.
+    """
+    path, positions = task
+    wanted = set(positions)
+    picked = []
+    for position, repository in enumerate(iter_repositories(path)):
+        if position in wanted:
+            picked.append(repository)
+            if len(picked) == len(wanted):
+                break
+    return picked
+
+
+def pick_all(
+    tasks: List[Tuple[str, List[int]]], num_processes: int
+) -> List[Dict[str, Any]]:
+    """
+    Returns the repositories at the given (batch file, sorted positions) pairs, reading the batch
+    files on the given number of worker processes.
+    """
+    if num_processes > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(num_processes) as worker_pool:
+            picked = worker_pool.map(pick, tasks)
+    else:
+        picked = [pick(task) for task in tasks]
+    return [repository for repositories in picked for repository in repositories]
+
+
+def reservoirs(
+    task: Tuple[List[Tuple[str, int]], int, int, Optional[int]]
+) -> Tuple[List[int], List[Reservoir]]:
+    """
+    Scans the given (batch file, stratum) pairs and keeps, for every stratum, the locations of the
+    repositories with the `size` smallest random keys.
+
+    Returns: Pair of (number of repositories seen per stratum, reservoir per stratum)
+    """
+    assigned_batches, strata, size, seed = task
+    rng = random.Random(seed)
+    counts = [0] * strata
+    # Max-heaps (keys are negated) so that the largest kept key can be replaced cheaply
+    heaps: List[Reservoir] = [[] for _ in range(strata)]
+    for path, stratum in assigned_batches:
+        heap = heaps[stratum]
+        for position, _ in enumerate(iter_repositories(path)):
+            counts[stratum] += 1
+            key = rng.random()
+            item = (-key, path, position)
+            if len(heap) < size:
+                heapq.heappush(heap, item)
+            elif -heap[0][0] > key:
+                heapq.heapreplace(heap, item)
+    return counts, [
+        [(-key, path, position) for key, path, position in heap] for heap in heaps
+    ]
+
+
+def sample_with_counts(
+    batches: List[Batch],
+    size: int,
+    strata: int,
+    num_processes: int,
+    seed: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Draws the sample positions from the known batch sizes and reads only the batch files which
+    contain at least one of them.
+    """
+    rng = random.Random(seed)
+    stratum_of_batch = assign_strata(batches, strata)
+    totals = [0] * max(strata, 1)
+    for batch, stratum in zip(batches, stratum_of_batch):
+        totals[stratum] += batch[2] or 0
+
+    positions: Dict[int, List[int]] = {}
+    for stratum, stratum_size in enumerate(allocate(size, totals)):
+        members = [i for i, s in enumerate(stratum_of_batch) if s == stratum]
+        offsets = []
+        offset = 0
+        for i in members:
+            offsets.append(offset)
+            offset += batches[i][2] or 0
+        for position in rng.sample(range(offset), stratum_size):
+            member = bisect.bisect_right(offsets, position) - 1
+            positions.setdefault(members[member], []).append(position - offsets[member])
+
+    tasks = [
+        (batches[i][0], sorted(batch_positions))
+        for i, batch_positions in sorted(positions.items())
+    ]
+    return pick_all(tasks, num_processes)
+
+
+def sample_with_reservoirs(
+    batches: List[Batch],
+    size: int,
+    strata: int,
+    num_processes: int,
+    seed: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Scans all batch files with one reservoir per worker and stratum, merges the reservoirs and
+    reads the sampled repositories from their batch files.
+    """
+    strata = max(strata, 1)
+    stratum_of_batch = assign_strata(batches, strata)
+    assigned = [
+        (batch[0], stratum) for batch, stratum in zip(batches, stratum_of_batch)
+    ]
+
+    concurrency = max(min(num_processes, len(assigned)), 1)
+    segment_size = int(len(assigned) / concurrency) + 1
+    rng = random.Random(seed)
+    tasks = [
+        (
+            assigned[i * segment_size : (i + 1) * segment_size],
+            strata,
+            size,
+            rng.randrange(2**32),
+        )
+        for i in range(concurrency)
+    ]
+    if concurrency > 1:
+        with multiprocessing.Pool(concurrency) as worker_pool:
+            results = worker_pool.map(reservoirs, tasks)
+    else:
+        results = [reservoirs(task) for task in tasks]
+
+    totals = [
+        sum(counts[stratum] for counts, _ in results) for stratum in range(strata)
+    ]
+    positions: Dict[str, List[int]] = {}
+    for stratum, stratum_size in enumerate(allocate(size, totals)):
+        merged = [item for _, kept in results for item in kept[stratum]]
+        for _, path, position in heapq.nsmallest(
+            stratum_size, merged, key=lambda item: item[0]
+        ):
+            positions.setdefault(path, []).append(position)
+
+    sampled = pick_all(
+        [
+            (path, sorted(batch_positions))
+            for path, batch_positions in positions.items()
+        ],
+        concurrency,
+    )
+    return sorted(sampled, key=lambda repository: repository.get("id", -1))
+
+
+def sample_fixed_size(
+    batches: List[Batch],
+    size: int,
+    strata: int = 1,
+    num_processes: int = 1,
+    seed: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Returns a uniform random sample of exactly `size` repositories from the given batches (or all
+    of them if there are fewer). If strata > 1, the sample is allocated proportionally over that
+    many equal-width ID ranges.
+
+    Args:
+    batches
+        (path, start ID, count) triples for the batch files to sample from. The count may be None
+        if it is not known.
+    size
+        Number of repositories to sample
+    strata
+        Number of ID ranges to sample from proportionally
+    num_processes
+        Number of worker processes reading batch files
+    seed
+        Seed for the random number generator (default: random)
+
+    Returns: List of sampled repositories
+    """
+    if all(batch[2] is not None for batch in batches):
+        return sample_with_counts(batches, size, strata, num_processes, seed)
+    return sample_with_reservoirs(batches, size, strata, num_processes, seed)
@@ -1,23 +1,42 @@
 import os
 import csv
 import json
+import datetime
+import math
 import time
 import string
 import traceback
 import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 
 
 import click
 import requests
 
 from ..settings import *
+from . import client
+from .batches import FORMATS
+from .seen import filter_new, open_seen, record_seen, seen_path
+from .segments import DEFAULT_MAX_SEGMENT_BYTES, SegmentWriter, next_file_index
+from .tokens import SEARCH_RESOURCE, TokenPool, load_tokens
 from .utils import forward_languages_config, request_with_limit
 
 
 DATETIME_HEADER = "Date"
 
+SEARCH_URL = "https://api.github.com/search/repositories"
+
+# The search API returns at most 10 pages of 100 results for any query
+MAX_PAGES = 10
+MAX_RESULTS = 1000
+
+PARTITIONS = ["letters", "stars"]
+
+# No repository on GitHub was created before this day
+GITHUB_EPOCH = datetime.date(2008, 1, 1)
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -31,12 +50,97 @@ def encode_query(stars_expression, language):
     return f"{stars_encoding}+{lang_encoding}"
 
 
-def get_total_count(search_query, headers, min_rate_limit):
-    search_url = (
-        f"https://api.github.com/search/repositories?q={search_query}&per_page=100"
-    )
+class Partition(NamedTuple):
+    """
+    Sub-query of a search: an inclusive range of stars and, optionally, an inclusive range of
+    creation dates.
+    """
 
-    search_response = request_with_limit(search_url, headers, min_rate_limit)
+    stars_low: int
+    stars_high: int
+    created_low: Optional[datetime.date] = None
+    created_high: Optional[datetime.date] = None
+
+    def query(self, language: str) -> str:
+        search_query = encode_query(f"{self.stars_low}..{self.stars_high}", language)
+        if self.created_low is not None:
+            created = f"created:{self.created_low}..{self.created_high}"
+            search_query += "+" + str(urllib.parse.quote(created))
+        return search_query
+
+    def split(self, split_created: bool) -> Optional[Tuple["Partition", "Partition"]]:
+        """
+        Splits the partition in two halves which together cover it.
+
+        Stars are split first. Star counts are heavy-tailed - most repositories have few stars and
+        few repositories have many - so the range is split at its geometric rather than arithmetic
+        midpoint, which keeps the halves much closer in size. A single star count is split by
+        creation date if split_created is set.
+
+        Returns: Pair of partitions, or None if the partition can not be split any further
+        """
+        low, high = self.stars_low, self.stars_high
+        if low < high:
+            middle = int(math.sqrt((low + 1) * (high + 1))) - 1
+            middle = min(max(middle, low), high - 1)
+            return (
+                self._replace(stars_high=middle),
+                self._replace(stars_low=middle + 1),
+            )
+
+        if not split_created:
+            return None
+
+        created_low = self.created_low or GITHUB_EPOCH
+        created_high = self.created_high or datetime.date.today()
+        if created_low >= created_high:
+            return None
+        middle_date = created_low + (created_high - created_low) // 2
+        return (
+            self._replace(created_low=created_low, created_high=middle_date),
+            self._replace(
+                created_low=middle_date + datetime.timedelta(days=1),
+                created_high=created_high,
+            ),
+        )
+
+
+def parse_stars_expression(
+    stars_expression: Optional[str],
+) -> Tuple[int, Optional[int]]:
+    """
+    Parses a stars expression of the search API ("500", ">500", ">=500", "<500", "<=500",
+    "10..500", "10..*", "*..500") into an inclusive range of stars.
+
+    Returns: Pair of (lowest, highest) number of stars. The highest is None if the range is open.
+    """
+    if not stars_expression:
+        return 0, None
+    expression = stars_expression.strip()
+    try:
+        if ".." in expression:
+            low, high = expression.split("..", 1)
+            return (
+                0 if low.strip() == "*" else int(low),
+                None if high.strip() == "*" else int(high),
+            )
+        if expression.startswith(">="):
+            return int(expression[2:]), None
+        if expression.startswith(">"):
+            return int(expression[1:]) + 1, None
+        if expression.startswith("<="):
+            return 0, int(expression[2:])
+        if expression.startswith("<"):
+            return 0, int(expression[1:]) - 1
+        return int(expression), int(expression)
+    except ValueError:
+        raise Error(f"Unsupported stars expression: {stars_expression}")
+
+
+def get_total_count(search_query, headers, min_rate_limit, pool=None):
+    search_url = f"{SEARCH_URL}?q={search_query}&per_page=100"
+
+    search_response = request_with_limit(search_url, headers, min_rate_limit, pool)
 
     click.echo(f" initial request done {search_url}")
 
@@ -46,32 +150,36 @@ def get_total_count(search_query, headers, min_rate_limit):
     return data.get("total_count")
 
 
-def write_repos(data, alredy_parsed, date, files_counter, path, language, search_query):
-
-    json_data = {"data": []}
+def get_max_stars(search_query, headers, min_rate_limit, pool=None):
+    """
+    Requests the most starred result of a search.
 
-    repos = data["items"]
+    Returns: Number of stars of the most starred result, or None if there are no results
+    """
+    search_url = f"{SEARCH_URL}?q={search_query}&sort=stars&order=desc&per_page=1"
 
-    for repo in repos:
+    search_response = request_with_limit(search_url, headers, min_rate_limit, pool)
 
-        if repo["id"] not in alredy_parsed:
+    click.echo(f" initial request done {search_url}")
 
-            json_data["data"].append(repo)
-        else:
-            continue
+    items = json.loads(search_response.text).get("items")
+    if not items:
+        return None
+    return items[0]["stargazers_count"]
 
-        alredy_parsed.add(repo["id"])
 
-    json_data["command"] = "search"
+def search_page(search_query, page, headers, min_rate_limit, pool=None):
+    """
+    Requests one page of search results.
 
-    json_data["crawled_at"] = date
-    json_data["language"] = language
-    json_data["search_query"] = search_query
+    Returns: Triple of (response body, Date header of the response, search URL)
+    """
+    search_url = f"{SEARCH_URL}?q={search_query}&per_page=100&page={page}"
 
-    file_path = os.path.join(path, f"{files_counter}.json")
+    search_response = request_with_limit(search_url, headers, min_rate_limit, pool)
 
-    with open(file_path, "w+", newline="") as output_file:
-        json.dump(json_data, output_file)
+    data = json.loads(search_response.text)
+    return data, search_response.headers.get(DATETIME_HEADER), search_url
 
 
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
@@ -84,7 +192,7 @@ def write_repos(data, alredy_parsed, date, files_counter, path, language, search
 @click.option(
     "--token",
     "-t",
-    help="Access token for increase rate limit. Read from env $GITHUB_TOKEN if specify.",
+    help="Access token or comma-separated tokens for increase rate limit. Read from env if not specified.",
     default=None,
     show_default=True,
 )
@@ -105,6 +213,54 @@ def write_repos(data, alredy_parsed, date, files_counter, path, language, search
 @click.option(
     "--languages-file", "-f", help="Path to json file with languages for extracting."
 )
+@click.option(
+    "--cache-dir",
+    default=None,
+    help="Directory for cached API responses, revalidated with ETags (default: $MIRROR_HTTP_CACHE_DIR).",
+)
+@click.option(
+    "--cache-max-size",
+    type=int,
+    default=1024,
+    show_default=True,
+    help="Maximum size of the response cache in megabytes.",
+)
+@click.option(
+    "--concurrency",
+    "-c",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of search requests in flight at the same time, over all languages.",
+)
+@click.option(
+    "--partition",
+    "-p",
+    type=click.Choice(PARTITIONS),
+    default="letters",
+    show_default=True,
+    help="How queries with more than 1000 results are split: by a letter prefix, or by bisecting the stars range until every sub-query has at most 1000 results.",
+)
+@click.option(
+    "--split-created",
+    is_flag=True,
+    help="With --partition stars, also bisect created: date ranges of single star counts which still have more than 1000 results.",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(list(FORMATS)),
+    default="json",
+    show_default=True,
+    help="Format of search result files.",
+)
+@click.option(
+    "--max-file-size",
+    type=int,
+    default=DEFAULT_MAX_SEGMENT_BYTES,
+    show_default=True,
+    help="Size in bytes (uncompressed) after which a new search result file is started.",
+)
 def popular_repos(
     languages: tuple,
     stars_expression: str,
@@ -112,12 +268,35 @@ def popular_repos(
     token: Optional[str],
     min_rate_limit: int,
     languages_file: str,
+    cache_dir: Optional[str],
+    cache_max_size: int,
+    concurrency: int,
+    partition: str,
+    split_created: bool,
+    output_format: str,
+    max_file_size: int,
 ):
     """
     Crawl via search api.
     Search api have limitation 1000 results per search quary.
     For extract more results from search for each request we adding letters of the alphabet to the query parameter.
 
+    With --partition stars the stars range is bisected instead, recursively, until every sub-query
+    has at most 1000 results (see Partition.split). The first page of every sub-query reports its
+    result count, so a sub-query which is small enough costs no extra request. Open ranges (">500")
+    are closed with the star count of the most starred result.
+
+    Repositories are written once per crawl directory, over all languages and runs: the IDs of the
+    repositories written so far are kept in a SQLite database in the crawl directory (see seen.py).
+    Pages without new repositories are not written, and new repositories are packed into result
+    files of up to --max-file-size bytes, numbered after the files of previous runs. A result file
+    holds repositories of several languages and queries, so it lists them under "languages" and
+    "search_queries" (instead of the single "language" and "search_query" of a file per page).
+    The language and query each repository was found with are kept in the seen set.
+
+    Languages, letters and pages are requested concurrently (--concurrency) under the search API
+    rate limit of the tokens, which GitHub keeps separately from the core API rate limit.
+
     For languages file have next format. Languages name must match with the github.
     {"languages":["lang1",
                   "lang2",
@@ -127,16 +306,14 @@ def popular_repos(
 
     """
 
-    if not token:
-        token = GITHUB_TOKEN
+    pool = TokenPool(load_tokens(token), min_rate_limit, SEARCH_RESOURCE)
+    client.configure_cache(cache_dir, cache_max_size * 1024 * 1024)
 
     headers = {
         "accept": "application/vnd.github.v3+json",
     }
 
-    if GITHUB_TOKEN is not None:
-        headers["Authorization"] = f"token {token}"
-    else:
+    if not pool.authenticated:
         click.echo(f"start with low rate limit")
 
     if not os.path.exists(crawldir):
@@ -153,76 +330,157 @@ def popular_repos(
             traceback.print_exc()
             print(f"Can't read langiages file. {err}")
 
-    files_counter = 0
-
-    for language in languages:
-
-        # create search expression
-        init_search_query = encode_query(stars_expression, language)
-
-        total_count = get_total_count(init_search_query, headers, min_rate_limit)
-        if not total_count:
-            continue
-
-        alredy_parsed: set = set()
-
-        # etract total count github limit is 10 page of search result
-        page_amount = total_count // 100
-
-        if total_count % 100 and total_count < 1000:
-            page_amount += 1
-
-        if not os.path.exists(crawldir):
-            os.makedirs(crawldir)
-
-        for letter in list(string.ascii_lowercase):
-
-            page = 1
-
-            try:
-
-                # limitation of search result
-                while len(alredy_parsed) <= total_count and page <= 10:
-
-                    if total_count > 1000:
-                        search_expresion = letter + "+" + init_search_query
-                    else:
-                        search_expresion = init_search_query
-
-                    # parsing block
-
-                    search_url = f"https://api.github.com/search/repositories?q={search_expresion}&per_page=100&page={page}"
+    seen_conn = open_seen(seen_path(crawldir))
+    repos_writer = SegmentWriter(
+        crawldir,
+        "search",
+        output_format,
+        max_file_size,
+        first_index=next_file_index(crawldir),
+    )
 
-                    search_response = request_with_limit(
-                        search_url, headers, min_rate_limit
-                    )
+    # Repos written to the current file are added to the seen set once the file is complete, so
+    # that an interrupted run does not mark repos as seen which were never written
+    pending_seen: List[Tuple[Any, ...]] = []
+    pending_ids: Set[int] = set()
+
+    def record_pending_seen() -> None:
+        if pending_seen:
+            record_seen(seen_conn, pending_seen)
+            pending_seen.clear()
+            pending_ids.clear()
+
+    # Total count of every language - only touched by this thread
+    total_counts: Dict[str, int] = {}
+
+    # future -> (language, search query, page, partition); page 0 is the total count request,
+    # or the most starred result request if partitioning by stars
+    pending: Dict[Future, Tuple[str, str, int, Optional[Partition]]] = {}
+
+    stars_low, stars_high = parse_stars_expression(stars_expression)
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+
+        def submit(
+            language: str,
+            search_query: str,
+            page: int,
+            query_partition: Optional[Partition] = None,
+        ) -> None:
+            if page == 0 and partition == "stars":
+                future = executor.submit(
+                    get_max_stars, search_query, headers, min_rate_limit, pool
+                )
+            elif page == 0:
+                future = executor.submit(
+                    get_total_count, search_query, headers, min_rate_limit, pool
+                )
+            else:
+                future = executor.submit(
+                    search_page, search_query, page, headers, min_rate_limit, pool
+                )
+            pending[future] = (language, search_query, page, query_partition)
+
+        def submit_partition(language: str, query_partition: Partition) -> None:
+            submit(language, query_partition.query(language), 1, query_partition)
+
+        for language in languages:
+            if partition == "stars" and stars_high is not None:
+                submit_partition(language, Partition(stars_low, stars_high))
+            else:
+                # create search expression
+                submit(language, encode_query(stars_expression, language), 0)
 
-                    data = json.loads(search_response.text)
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    language, search_query, page, query_partition = pending.pop(future)
+
+                    if page == 0 and partition == "stars":
+                        max_stars = future.result()
+                        if max_stars is None:
+                            continue
+                        submit_partition(
+                            language, Partition(stars_low, max(max_stars, stars_low))
+                        )
+                        continue
+
+                    if page == 0:
+                        total_count = future.result()
+                        if not total_count:
+                            continue
+                        total_counts[language] = total_count
+
+                        if total_count > MAX_RESULTS:
+                            for letter in string.ascii_lowercase:
+                                submit(language, letter + "+" + search_query, 1)
+                        else:
+                            submit(language, search_query, 1)
+                        continue
+
+                    data, date, search_url = future.result()
 
                     if not data.get("items"):
-                        break
-
-                    files_counter += 1
-
-                    write_repos(
-                        data,
-                        alredy_parsed,
-                        search_response.headers.get(DATETIME_HEADER),
-                        files_counter,
-                        crawldir,
-                        language,
-                        search_url,
-                    )
-
-                    page += 1
-            except KeyboardInterrupt:
-                raise KeyboardInterrupt("CTRL+C")
-            except:
-                traceback.print_exc()
-                raise
-
-            if total_count <= 1000:
-                break
+                        continue
+
+                    query_count = data.get("total_count") or 0
+
+                    # Too many results for one query - bisect it instead of writing this page,
+                    # which the halves will return again
+                    if (
+                        page == 1
+                        and query_partition is not None
+                        and query_count > MAX_RESULTS
+                    ):
+                        halves = query_partition.split(split_created)
+                        if halves is not None:
+                            for half in halves:
+                                submit_partition(language, half)
+                            continue
+                        click.echo(
+                            f"Query has {query_count} results, only {MAX_RESULTS} can be retrieved: {search_url}",
+                            err=True,
+                        )
+
+                    new_repos = filter_new(seen_conn, data["items"], pending_ids)
+                    if new_repos:
+                        segment_index = repos_writer.index
+                        repos_writer.write(
+                            new_repos,
+                            date,
+                            metadata={
+                                "languages": language,
+                                "search_queries": search_url,
+                            },
+                        )
+                        for repo in new_repos:
+                            pending_ids.add(repo["id"])
+                            pending_seen.append(
+                                (repo["id"], language, search_url, date)
+                            )
+                        if repos_writer.index != segment_index:
+                            record_pending_seen()
+
+                    # The first page tells how many pages the query has - request the others
+                    # all at once
+                    if page == 1:
+                        page_amount = min(math.ceil(query_count / 100), MAX_PAGES)
+                        for next_page in range(2, page_amount + 1):
+                            submit(language, search_query, next_page, query_partition)
+        except KeyboardInterrupt:
+            for future in pending:
+                future.cancel()
+            raise KeyboardInterrupt("CTRL+C")
+        except:
+            for future in pending:
+                future.cancel()
+            traceback.print_exc()
+            raise
+        finally:
+            repos_writer.close()
+            record_pending_seen()
+            seen_conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+"""
+Persistent set of the repositories which "mirror search" has already written to its crawl directory.
+
+The set is a SQLite database (.mirror_seen.sqlite in the search crawl directory) with one row per
+repository ID, together with the language and search query under which the repository was first
+found. Search results are checked against it before they are written, so that every repository is
+written once over all languages, partitions and runs into the same directory.
+"""
+
+import os
+import sqlite3
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+SEEN_FILE = ".mirror_seen.sqlite"
+
+COLUMNS = ["repo_id", "language", "search_query", "crawled_at"]
+
+# Stay well below the SQLite limit on the number of variables of a statement
+LOOKUP_CHUNK_SIZE = 500
+
+insert_seen = f"""
+INSERT OR IGNORE INTO repositories({", ".join(COLUMNS)})
+VALUES ({", ".join(["?"] * len(COLUMNS))});
+"""
+
+
+def seen_path(crawldir: str) -> str:
+    return os.path.join(crawldir, SEEN_FILE)
+
+
+def open_seen(path: str) -> sqlite3.Connection:
+    """
+    Opens (and if necessary creates) the seen set database at the given path.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+
+    create_repositories = """
+    CREATE TABLE IF NOT EXISTS repositories (
+        repo_id UNSIGNED BIG INT PRIMARY KEY,
+        language TEXT,
+        search_query TEXT,
+        crawled_at TEXT
+    );
+    """
+
+    c = conn.cursor()
+    c.execute(create_repositories)
+    conn.commit()
+    return conn
+
+
+def seen_ids(conn: sqlite3.Connection, repo_ids: List[int]) -> Set[int]:
+    """
+    Returns those of the given repository IDs which are in the seen set.
+    """
+    found: Set[int] = set()
+    for i in range(0, len(repo_ids), LOOKUP_CHUNK_SIZE):
+        chunk = repo_ids[i : i + LOOKUP_CHUNK_SIZE]
+        rows = conn.execute(
+            f"SELECT repo_id FROM repositories WHERE repo_id IN ({', '.join(['?'] * len(chunk))});",
+            chunk,
+        )
+        found.update(repo_id for (repo_id,) in rows)
+    return found
+
+
+def filter_new(
+    conn: sqlite3.Connection, repos: List[Dict[str, Any]], pending: Set[int]
+) -> List[Dict[str, Any]]:
+    """
+    Returns the repositories which are neither in the seen set nor in the given set of IDs which
+    will be added to it (see record_seen), without duplicates.
+    """
+    known = seen_ids(conn, [repo["id"] for repo in repos])
+    new_repos = []
+    for repo in repos:
+        if repo["id"] in known or repo["id"] in pending:
+            continue
+        known.add(repo["id"])
+        new_repos.append(repo)
+    return new_repos
+
+
+def record_seen(conn: sqlite3.Connection, rows: Iterable[Tuple[Any, ...]]) -> None:
+    """
+    Adds the given (repo_id, language, search_query, crawled_at) rows to the seen set in one
+    transaction. Repositories which are already in it keep their first row.
+    """
+    conn.executemany(insert_seen, rows)
+    conn.commit()
@@ -0,0 +1,204 @@
+"""
+Append-only, size-rotated output files for per-repository records (e.g. the output of the commits
+command).
+
+Records are streamed into numbered segments <index><extension> in an output directory. A segment is
+closed and the next one is opened once the segment has grown past a maximum size, so no file is
+ever read back or rewritten while the command runs.
+
+Segments use the JSON lines layout of crawl batches (see batches.py), optionally compressed with
+gzip or zstd:
+{"mirror_record": "header", "command": ...}
+<record>
+...
+{"mirror_record": "footer", "crawled_at": ..., "count": ..., <metadata>}
+
+The "json" format keeps the legacy layout - a single {"command": ..., "data": [...], "crawled_at":
+...} object per segment. Its records are buffered in memory and each segment is written once, when
+it is closed.
+
+Writers may attach metadata to records (for example the search query they were found with). The
+distinct values of every metadata key in a segment are stored as a list in its footer, or in the
+top-level object of json segments.
+"""
+
+import json
+import os
+from typing import Any, Dict, IO, List, Optional
+
+from .batches import (
+    FOOTER_RECORD,
+    FORMATS,
+    HEADER_RECORD,
+    RECORD_TYPE_KEY,
+    BatchFormatError,
+    open_text,
+)
+from .ranges import list_repos_files
+
+DEFAULT_MAX_SEGMENT_BYTES = 5000000
+
+
+def next_file_index(directory: str) -> int:
+    """
+    Returns the number of the next segment in the given directory, after the segments written by
+    previous runs.
+    """
+    numbers = [
+        int(file_name.split(".")[0])
+        for file_name in list_repos_files(directory)
+        if file_name.split(".")[0].isdigit()
+    ]
+    return max(numbers, default=0) + 1
+
+
+class SegmentWriter:
+    """
+    Writes records to size-rotated segments in the given directory, starting at segment number
+    first_index.
+
+    Size regulation is based on the number of uncompressed bytes written, and a segment is only
+    rotated between two calls to write() - all records passed to a single write() call end up in
+    the same segment.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        command: str,
+        format: str = "jsonl",
+        max_bytes: int = DEFAULT_MAX_SEGMENT_BYTES,
+        first_index: int = 1,
+    ) -> None:
+        if format not in FORMATS:
+            raise BatchFormatError(f"Unknown segment format: {format}")
+        self.directory = directory
+        self.command = command
+        self.format = format
+        self.max_bytes = max_bytes
+        self.index = first_index
+        self.count = 0
+        self.size = 0
+        self.crawled_at: Optional[str] = None
+        self.metadata: Dict[str, List[Any]] = {}
+        self._data: List[Dict[str, Any]] = []
+        self._ofp: Optional[IO[str]] = None
+        self._is_open = False
+
+    @property
+    def file_name(self) -> str:
+        """
+        Name of the segment the next records will be written to.
+        """
+        return f"{self.index}{FORMATS[self.format]}"
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, self.file_name)
+
+    def _write_line(self, item: Dict[str, Any]) -> None:
+        assert self._ofp is not None
+        line = json.dumps(item) + "\n"
+        self._ofp.write(line)
+        self.size += len(line)
+
+    def _open(self) -> None:
+        self._is_open = True
+        self.count = 0
+        self.size = 0
+        self.crawled_at = None
+        self.metadata = {}
+        if self.format == "json":
+            self._data = []
+            return
+        self._ofp = open_text(self.path, "w")
+        self._write_line({RECORD_TYPE_KEY: HEADER_RECORD, "command": self.command})
+
+    def write(
+        self,
+        records: List[Dict[str, Any]],
+        crawled_at: Optional[str] = None,
+        rotate: bool = True,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Appends the given records to the current segment and rotates the segment if it has
+        outgrown the maximum size.
+
+        Args:
+        records
+            Records to write
+        crawled_at
+            Time at which the records were retrieved (e.g. the Date header of the API response).
+            The value of the last write is stored as the crawled_at of the segment.
+        rotate
+            If False, the segment is not rotated even if it has outgrown the maximum size - for
+            example because more records of the same repository follow. Call rotate_if_full()
+            once they have been written.
+        metadata
+            Metadata of the records. Each value is added to the list of values of its key in the
+            segment, unless it is already in it.
+        """
+        if not self._is_open:
+            self._open()
+
+        if self.format == "json":
+            self._data.extend(records)
+            self.size += sum(len(json.dumps(record)) + 2 for record in records)
+        else:
+            for record in records:
+                self._write_line(record)
+        self.count += len(records)
+        if crawled_at is not None:
+            self.crawled_at = crawled_at
+        for key, value in (metadata or {}).items():
+            values = self.metadata.setdefault(key, [])
+            if value not in values:
+                values.append(value)
+
+        if rotate:
+            self.rotate_if_full()
+
+    def rotate_if_full(self) -> None:
+        """
+        Rotates the current segment if it has outgrown the maximum size.
+        """
+        if self.size > self.max_bytes:
+            self.rotate()
+
+    def rotate(self) -> None:
+        """
+        Closes the current segment (if anything was written to it) and moves on to the next one.
+        """
+        if not self._is_open:
+            return
+
+        if self.format == "json":
+            with open(self.path, "w", encoding="utf8") as ofp:
+                json.dump(
+                    {
+                        "command": self.command,
+                        "data": self._data,
+                        "crawled_at": self.crawled_at,
+                        **self.metadata,
+                    },
+                    ofp,
+                )
+            self._data = []
+        else:
+            footer = {
+                RECORD_TYPE_KEY: FOOTER_RECORD,
+                "crawled_at": self.crawled_at,
+                "count": self.count,
+                **self.metadata,
+            }
+            self._write_line(footer)
+            assert self._ofp is not None
+            self._ofp.close()
+            self._ofp = None
+
+        self._is_open = False
+        self.index += 1
+
+    def close(self) -> None:
+        self.rotate()
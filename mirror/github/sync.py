@@ -3,15 +3,18 @@ Synchronize repository metadata into a SQLite database
 """
 
 import argparse
+from collections import deque
 from datetime import datetime, timezone
 import json
+import multiprocessing
 import sqlite3
 import sys
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 from tqdm import tqdm  # type: ignore
 import click
 from .allrepos import ordered_crawl
+from .batches import iter_repositories
 
 
 def setup_database(conn: sqlite3.Connection) -> None:
@@ -51,6 +54,131 @@ def setup_database(conn: sqlite3.Connection) -> None:
     conn.commit()
 
 
+REPOSITORY_COLUMNS = [
+    "github_id",
+    "full_name",
+    "owner",
+    "html_url",
+    "api_url",
+    "is_fork",
+]
+
+STAGING_TABLE = "repositories_staging"
+
+BULK_PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -262144;",
+    "PRAGMA mmap_size = 1073741824;",
+    "PRAGMA temp_store = MEMORY;",
+]
+
+
+def has_github_id_key(conn: sqlite3.Connection) -> bool:
+    """
+    Returns True if the repositories table has a unique index on github_id - i.e. if it was built
+    by a bulk load and rows can be upserted into it.
+    """
+    c = conn.cursor()
+    c.execute("PRAGMA index_list(repositories);")
+    for _, name, unique, *_ in c.fetchall():
+        if unique and name == "repositories_github_id":
+            return True
+    return False
+
+
+def setup_bulk_load(conn: sqlite3.Connection) -> None:
+    """
+    Prepares a SQLite3 database for a bulk load: tunes journaling and caching and creates an
+    unindexed staging table with the columns of the repositories table. A staging table left over
+    from an interrupted bulk load is kept - its rows are already recorded in the history table.
+
+    Args:
+    conn
+        Open connection to SQLite database
+
+    Returns: None
+    """
+    c = conn.cursor()
+    for pragma in BULK_PRAGMAS:
+        c.execute(pragma)
+
+    create_staging = f"""
+    CREATE TABLE IF NOT EXISTS {STAGING_TABLE} (
+        github_id UNSIGNED BIG INT,
+        full_name TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        html_url TEXT NOT NULL,
+        api_url TEXT NOT NULL,
+        is_fork BOOLEAN
+    );
+    """
+    c.execute(create_staging)
+    conn.commit()
+
+
+def finish_bulk_load(conn: sqlite3.Connection) -> None:
+    """
+    Moves the rows of the staging table into the repositories table and builds its indexes: a
+    unique index on github_id (serving as its key) and secondary indexes on owner and full_name.
+
+    If the repositories table is empty, the staged rows are copied in github_id order and the
+    indexes are built once afterwards. Otherwise, the staged rows are upserted - rows for
+    repositories that are already present are updated in place instead of being duplicated.
+
+    Args:
+    conn
+        Open connection to SQLite database
+
+    Returns: None
+    """
+    columns = ", ".join(REPOSITORY_COLUMNS)
+    updates = ", ".join(
+        f"{column} = excluded.{column}" for column in REPOSITORY_COLUMNS[1:]
+    )
+    # Later rows win if a repository was staged more than once
+    latest_staged = f"""
+    SELECT {columns} FROM {STAGING_TABLE}
+    WHERE rowid IN (SELECT MAX(rowid) FROM {STAGING_TABLE} GROUP BY github_id)
+    ORDER BY github_id
+    """
+
+    c = conn.cursor()
+    c.execute("SELECT EXISTS (SELECT 1 FROM repositories);")
+    is_empty = not c.fetchone()[0]
+
+    if is_empty:
+        c.execute("DROP INDEX IF EXISTS repositories_github_id;")
+        c.execute("DROP INDEX IF EXISTS repositories_owner;")
+        c.execute("DROP INDEX IF EXISTS repositories_full_name;")
+        c.execute(f"INSERT INTO repositories({columns}) {latest_staged};")
+    elif not has_github_id_key(conn):
+        # Repositories synchronized before indexes existed may have been inserted several times
+        c.execute(
+            """
+            DELETE FROM repositories
+            WHERE rowid NOT IN (SELECT MAX(rowid) FROM repositories GROUP BY github_id);
+            """
+        )
+
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS repositories_github_id ON repositories(github_id);"
+    )
+    if not is_empty:
+        c.execute(
+            f"""
+            INSERT INTO repositories({columns}) {latest_staged}
+            ON CONFLICT(github_id) DO UPDATE SET {updates};
+            """
+        )
+    c.execute("CREATE INDEX IF NOT EXISTS repositories_owner ON repositories(owner);")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS repositories_full_name ON repositories(full_name);"
+    )
+    c.execute(f"DROP TABLE {STAGING_TABLE};")
+    conn.commit()
+
+
 class SyncParseError(Exception):
     """
     Returned if there was an error parsing repository metadata
@@ -98,28 +226,28 @@ def parse_repository_metadata(
     return parsed_metadata, None
 
 
-def unsynced_results(
-    conn: sqlite3.Connection, results: List[Tuple[str, int]]
-) -> Iterator[Tuple[Dict[str, Any], Optional[SyncParseError]]]:
+def last_synced_id(conn: sqlite3.Connection) -> int:
     """
-    Given a sorted list of items in a crawl directory (as returned by allrepos.ordered_crawl),
-    iterates over the entries that need to be synchronized into the given database.
-
-    Args:
-    conn
-        Open connection to SQLite database
-    results
-        Results as returned by allrepos.ordered_crawl
-
-    Yields: Dictionaries representing individual repositories to be synchronized into database
+    Returns the ID of the last repository synchronized into the given database (-1 if none).
     """
-    last_id = -1
     c = conn.cursor()
     selector = "SELECT MAX(github_id) FROM history;"
     c.execute(selector)
     r = c.fetchone()
     if r[0] is not None:
-        last_id = r[0]
+        return r[0]
+    return -1
+
+
+def unsynced_batches(
+    conn: sqlite3.Connection, results: List[Tuple[str, int]]
+) -> List[Tuple[str, int]]:
+    """
+    Given a sorted list of items in a crawl directory (as returned by allrepos.ordered_crawl),
+    returns the crawl result files that need to be synchronized into the given database, each with
+    the ID above which its repositories need to be synchronized (-1 for all of them).
+    """
+    last_id = last_synced_id(conn)
 
     cutoff = -1
     for i, result in enumerate(results):
@@ -128,69 +256,140 @@ def unsynced_results(
         else:
             break
 
+    tasks: List[Tuple[str, int]] = []
     if cutoff > -1:
         result_file, _ = results[cutoff]
-        with open(result_file, "r") as ifp:
-            crawl_result = json.load(ifp)
-        data = crawl_result.get("data", [])
-        for item in data:
-            if item.get("id", -1) > last_id:
-                yield parse_repository_metadata(result_file, item)
-
-    if cutoff == len(results) - 1:
-        return None
-
-    for result_file, _ in results[cutoff + 1 :]:
-        with open(result_file, "r") as ifp:
-            crawl_result = json.load(ifp)
-        for item in crawl_result.get("data", []):
+        tasks.append((result_file, last_id))
+    tasks.extend((result_file, -1) for result_file, _ in results[cutoff + 1 :])
+    return tasks
+
+
+def unsynced_results(
+    conn: sqlite3.Connection, results: List[Tuple[str, int]]
+) -> Iterator[Tuple[Dict[str, Any], Optional[SyncParseError]]]:
+    """
+    Given a sorted list of items in a crawl directory (as returned by allrepos.ordered_crawl),
+    iterates over the entries that need to be synchronized into the given database.
+
+    Args:
+    conn
+        Open connection to SQLite database
+    results
+        Results as returned by allrepos.ordered_crawl
+
+    Yields: Dictionaries representing individual repositories to be synchronized into database
+    """
+    for result_file, last_id in unsynced_batches(conn, results):
+        for item in iter_repositories(result_file):
+            if last_id > -1 and item.get("id", -1) <= last_id:
+                continue
             yield parse_repository_metadata(result_file, item)
 
 
-def sync(
+def repository_row(item: Dict[str, Any]) -> Tuple[Any, ...]:
+    """
+    Projects parsed repository metadata onto the columns of the repositories table.
+    """
+    return (
+        item["id"],
+        item["full_name"],
+        item["owner_login"],
+        item["html_url"],
+        item["url"],
+        item["fork"],
+    )
+
+
+def parse_batch(task: Tuple[str, int]) -> Tuple[List[Tuple[Any, ...]], List[str]]:
+    """
+    Parses a crawl result file into rows for the repositories table. Runs in worker processes of
+    parallel_sync.
+
+    Args:
+    task
+        Pair of (crawl result file, ID above which repositories need to be synchronized) as
+        returned by unsynced_batches
+
+    Returns: Pair of (rows to insert, descriptions of parse errors)
+    """
+    result_file, last_id = task
+    rows: List[Tuple[Any, ...]] = []
+    errors: List[str] = []
+    for item in iter_repositories(result_file):
+        if last_id > -1 and item.get("id", -1) <= last_id:
+            continue
+        parsed_item, err = parse_repository_metadata(result_file, item)
+        if err is not None:
+            errors.append(repr(err))
+            continue
+        rows.append(repository_row(parsed_item))
+    return rows, errors
+
+
+def parsed_batches(
+    tasks: List[Tuple[str, int]], num_processes: int, queue_size: int
+) -> Iterator[Tuple[List[Tuple[Any, ...]], List[str]]]:
+    """
+    Parses the given crawl result files in a pool of worker processes and yields their rows in the
+    order of the files. At most queue_size files are parsed ahead of the consumer, which bounds the
+    memory used by parsed rows waiting to be written.
+    """
+    with multiprocessing.Pool(num_processes) as worker_pool:
+        pending: Deque[Any] = deque()
+        for task in tasks:
+            pending.append(worker_pool.apply_async(parse_batch, (task,)))
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def sync_rows(
     conn: sqlite3.Connection,
-    results: Iterator[Tuple[Dict[str, Any], Optional[SyncParseError]]],
+    rows: Iterator[Tuple[Any, ...]],
     batch_size: int,
+    table: str = "repositories",
 ) -> int:
     """
-    Synchronizes a list of results from a github crawl into the SQLite database represented by the
-    given connection.
+    Inserts rows for the repositories table into the SQLite database represented by the given
+    connection, recording progress in the history table after every transaction.
+
+    Rows are upserted if the target table has a unique index on github_id (see finish_bulk_load),
+    so that synchronizing a repository again updates it instead of adding a duplicate.
 
     Args:
     conn
         Open connection to SQLite database
-    results
-        List of paths to crawl result files from which to sync to the database
-
-    Returns: None
+    rows
+        Rows as returned by repository_row, ordered by GitHub ID
+    batch_size
+        Number of rows to insert per transaction
+    table
+        Table into which rows should be inserted (repositories, or the staging table of a bulk
+        load)
+
+    Returns: Number of synchronized repositories
     """
     c = conn.cursor()
 
-    insertion = """
-    INSERT INTO repositories(github_id, full_name, owner, html_url, api_url, is_fork)
+    insertion = f"""
+    INSERT INTO {table}(github_id, full_name, owner, html_url, api_url, is_fork)
     VALUES (?, ?, ?, ?, ?, ?)
     """
+    if table == "repositories" and has_github_id_key(conn):
+        updates = ", ".join(
+            f"{column} = excluded.{column}" for column in REPOSITORY_COLUMNS[1:]
+        )
+        insertion += f"ON CONFLICT(github_id) DO UPDATE SET {updates}"
 
     update_history = "INSERT INTO history(github_id, synced_at) VALUES (?, ?)"
 
     synced = 0
     batch = []
     github_id = -1
-    for item, err in tqdm(results):
-        if err is not None:
-            print("Parse error - {}".format(repr(err)), file=sys.stderr)
-            continue
-
-        parsed_item = (
-            item["id"],
-            item["full_name"],
-            item["owner_login"],
-            item["html_url"],
-            item["url"],
-            item["fork"],
-        )
-        batch.append(parsed_item)
-        github_id = item["id"]
+    for row in rows:
+        batch.append(row)
+        github_id = row[0]
 
         if len(batch) % batch_size == 0:
             c.executemany(insertion, batch)
@@ -208,6 +407,81 @@ def sync(
     return synced
 
 
+def sync(
+    conn: sqlite3.Connection,
+    results: Iterator[Tuple[Dict[str, Any], Optional[SyncParseError]]],
+    batch_size: int,
+    table: str = "repositories",
+) -> int:
+    """
+    Synchronizes a list of results from a github crawl into the SQLite database represented by the
+    given connection.
+
+    Args:
+    conn
+        Open connection to SQLite database
+    results
+        List of paths to crawl result files from which to sync to the database
+    batch_size
+        Number of rows to insert per transaction
+    table
+        Table into which rows should be inserted
+
+    Returns: None
+    """
+
+    def rows() -> Iterator[Tuple[Any, ...]]:
+        for item, err in tqdm(results):
+            if err is not None:
+                print("Parse error - {}".format(repr(err)), file=sys.stderr)
+                continue
+            yield repository_row(item)
+
+    return sync_rows(conn, rows(), batch_size, table)
+
+
+def parallel_sync(
+    conn: sqlite3.Connection,
+    results: List[Tuple[str, int]],
+    batch_size: int,
+    num_processes: int,
+    queue_size: int,
+    table: str = "repositories",
+) -> int:
+    """
+    Synchronizes the results of a github crawl into the SQLite database represented by the given
+    connection. Crawl result files are parsed by a pool of worker processes and their rows are
+    written by the calling process, which owns the connection.
+
+    Args:
+    conn
+        Open connection to SQLite database
+    results
+        Results as returned by allrepos.ordered_crawl
+    batch_size
+        Number of rows to insert per transaction
+    num_processes
+        Number of worker processes parsing crawl result files
+    queue_size
+        Maximum number of parsed crawl result files waiting to be written
+    table
+        Table into which rows should be inserted
+
+    Returns: Number of synchronized repositories
+    """
+    tasks = unsynced_batches(conn, results)
+
+    def rows() -> Iterator[Tuple[Any, ...]]:
+        for batch_rows, errors in tqdm(
+            parsed_batches(tasks, num_processes, queue_size), total=len(tasks)
+        ):
+            for err in errors:
+                print("Parse error - {}".format(err), file=sys.stderr)
+            yield from batch_rows
+
+    return sync_rows(conn, rows(), batch_size, table)
+
+
 @click.command(context_settings=dict(help_option_names=["-h", "--help"]))
 @click.option(
     "--setup", help="If set, creates the relevant tables in the given database"
@@ -223,7 +497,34 @@ def sync(
     help="Number of repositories to sync at a time (database transaction batching)",
 )
 @click.option("--database", "-o", help="Path to database file")
-def handler(setup: str, crawldir: str, batch_size: int, database: str) -> None:
+@click.option(
+    "--num-processes",
+    "-p",
+    type=int,
+    default=1,
+    help="Number of processes parsing crawl result files (more than 1 enables the parallel pipeline)",
+)
+@click.option(
+    "--queue-size",
+    "-q",
+    type=int,
+    default=None,
+    help="Maximum number of parsed crawl result files waiting to be written (default: 2 per process)",
+)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Load into an unindexed staging table with tuned PRAGMAs, then upsert and build indexes once",
+)
+def handler(
+    setup: str,
+    crawldir: str,
+    batch_size: int,
+    database: str,
+    num_processes: int,
+    queue_size: Optional[int],
+    bulk: bool,
+) -> None:
     """
     CLI handler for sync functionality
 
@@ -238,8 +539,25 @@ def handler(setup: str, crawldir: str, batch_size: int, database: str) -> None:
         if setup:
             setup_database(conn)
 
+        table = "repositories"
+        if bulk:
+            setup_bulk_load(conn)
+            table = STAGING_TABLE
+
         results = ordered_crawl(crawldir)
-        tasks = unsynced_results(conn, results)
-        print(sync(conn, tasks, batch_size))
+        if num_processes > 1:
+            if queue_size is None:
+                queue_size = 2 * num_processes
+            print(
+                parallel_sync(
+                    conn, results, batch_size, num_processes, queue_size, table
+                )
+            )
+        else:
+            tasks = unsynced_results(conn, results)
+            print(sync(conn, tasks, batch_size, table))
+
+        if bulk:
+            finish_bulk_load(conn)
     finally:
         conn.close()
@@ -0,0 +1,245 @@
+"""
+Pool of GitHub access tokens with rate limit aware scheduling.
+
+Every request is sent with the token which has the most remaining rate limit. Tokens whose
+remaining rate limit drops to the minimum are parked until their X-RateLimit-Reset time, and
+callers only have to wait when every token in the pool is parked.
+
+Requests which have been handed a token but have not reported back yet count against the token's
+remaining rate limit, so that concurrent workers sharing a pool do not overshoot the minimum.
+
+GitHub keeps separate rate limits for separate API resources (e.g. "core" and "search"), and names
+the resource a response counted against in the X-RateLimit-Resource header. A pool tracks the
+budget of a single resource and ignores rate limit headers of responses for other resources.
+"""
+
+import sys
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from ..settings import GITHUB_TOKEN, GITHUB_TOKENS, GITHUB_TOKENS_FILE
+
+REMAINING_RATELIMIT_HEADER = "X-RateLimit-Remaining"
+X_RATELIMIT_RESET = "X-RateLimit-Reset"
+X_RATELIMIT_RESOURCE = "X-RateLimit-Resource"
+
+CORE_RESOURCE = "core"
+SEARCH_RESOURCE = "search"
+
+# Remaining rate limit assumed for a token before GitHub has told us anything about it
+UNKNOWN_REMAINING = sys.maxsize
+
+# Interval at which acquire checks back when all budget is taken up by requests in flight
+IN_FLIGHT_POLL_SECONDS = 0.05
+
+# (min_rate_limit, resource) -> pool over the tokens configured in the environment
+_default_pools: Dict[Tuple[int, str], "TokenPool"] = {}
+_default_pools_lock = threading.Lock()
+
+
+class TokenPoolExhausted(Exception):
+    """Raised when every token in the pool has reached the minimum rate limit."""
+
+    pass
+
+
+def load_tokens(token: Optional[str] = None) -> List[Optional[str]]:
+    """
+    Returns the GitHub tokens which should be used to make requests.
+
+    Sources are checked in order and the first one that is set wins:
+    1. The given token argument (comma-separated list of tokens)
+    2. $GITHUB_TOKENS (comma-separated list of tokens)
+    3. $GITHUB_TOKENS_FILE (file with one token per line)
+    4. $GITHUB_TOKEN
+
+    Args:
+    token
+        Token (or comma-separated tokens) passed explicitly, for example from the command line
+
+    Returns: List of tokens. If no tokens are configured, this is [None] - a single anonymous
+    "token" with the low unauthenticated rate limit.
+    """
+    raw_tokens: List[str] = []
+    if token:
+        raw_tokens = token.split(",")
+    elif GITHUB_TOKENS:
+        raw_tokens = GITHUB_TOKENS.split(",")
+    elif GITHUB_TOKENS_FILE:
+        with open(GITHUB_TOKENS_FILE, "r") as ifp:
+            raw_tokens = ifp.read().splitlines()
+    elif GITHUB_TOKEN:
+        raw_tokens = [GITHUB_TOKEN]
+
+    tokens: List[Optional[str]] = []
+    for raw_token in raw_tokens:
+        raw_token = raw_token.strip()
+        if raw_token and raw_token not in tokens:
+            tokens.append(raw_token)
+
+    if not tokens:
+        return [None]
+    return tokens
+
+
+class TokenPool:
+    """
+    Thread-safe scheduler over a set of GitHub tokens.
+    """
+
+    def __init__(
+        self,
+        tokens: List[Optional[str]],
+        min_rate_limit: int = 0,
+        resource: str = CORE_RESOURCE,
+    ) -> None:
+        if not tokens:
+            tokens = [None]
+        self.tokens = tokens
+        self.min_rate_limit = min_rate_limit
+        self.resource = resource
+        self._lock = threading.Lock()
+        self._remaining: Dict[Optional[str], int] = {
+            token: UNKNOWN_REMAINING for token in tokens
+        }
+        self._parked_until: Dict[Optional[str], float] = {}
+        self._in_flight: Dict[Optional[str], int] = {token: 0 for token in tokens}
+
+    @property
+    def authenticated(self) -> bool:
+        return self.tokens != [None]
+
+    def _unpark(self, now: float) -> None:
+        for token, parked_until in list(self._parked_until.items()):
+            if parked_until <= now:
+                del self._parked_until[token]
+                self._remaining[token] = UNKNOWN_REMAINING
+
+    def _budget(self, token: Optional[str]) -> int:
+        return self._remaining[token] - self._in_flight[token]
+
+    def acquire(self, block: bool = True) -> Optional[str]:
+        """
+        Returns the token with the most remaining rate limit. Every token returned by acquire must
+        be handed back with update() (or release(), if no response was received).
+
+        If the budget of every token that is not parked is taken up by requests in flight, waits
+        for their responses. If every token is parked, either waits until the first of them is
+        reset (block=True) or raises TokenPoolExhausted (block=False).
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._unpark(now)
+                unparked = [
+                    token for token in self.tokens if token not in self._parked_until
+                ]
+                available = [
+                    token
+                    for token in unparked
+                    if self._budget(token) > self.min_rate_limit
+                ]
+                if available:
+                    token = max(available, key=self._budget)
+                    self._in_flight[token] += 1
+                    return token
+                if unparked:
+                    # Responses in flight will either park these tokens or free their budget
+                    wait_for_responses = True
+                else:
+                    wait_for_responses = False
+                    wake_at = min(self._parked_until.values())
+
+            if wait_for_responses:
+                time.sleep(IN_FLIGHT_POLL_SECONDS)
+                continue
+            if not block:
+                raise TokenPoolExhausted(
+                    f"All {len(self.tokens)} tokens reached the minimum rate limit"
+                )
+            time.sleep(max(wake_at - time.time(), 0) + 1)
+
+    def update(self, token: Optional[str], headers: Mapping[str, str]) -> None:
+        """
+        Records the rate limit state reported in the headers of a response made with the given
+        token, and parks the token until its reset time if it has reached the minimum rate limit.
+        Headers of responses which counted against another resource than the pool's are ignored.
+        """
+        self.release(token)
+
+        resource = headers.get(X_RATELIMIT_RESOURCE)
+        if resource is not None and resource != self.resource:
+            return
+
+        remaining_raw = headers.get(REMAINING_RATELIMIT_HEADER)
+        if remaining_raw is None:
+            return
+        try:
+            remaining = int(remaining_raw)
+        except ValueError:
+            return
+
+        with self._lock:
+            self._remaining[token] = remaining
+            if remaining <= self.min_rate_limit:
+                reset_raw = headers.get(X_RATELIMIT_RESET)
+                try:
+                    reset_at = float(reset_raw) if reset_raw is not None else 0.0
+                except ValueError:
+                    reset_at = 0.0
+                self._parked_until[token] = max(reset_at, time.time() + 1)
+
+    def release(self, token: Optional[str]) -> None:
+        """
+        Hands back a token returned by acquire() without a response to learn its rate limit from.
+        """
+        with self._lock:
+            self._in_flight[token] = max(self._in_flight[token] - 1, 0)
+
+    def remaining(self) -> int:
+        """
+        Returns the largest remaining rate limit over the tokens in the pool. Tokens for which no
+        response has been seen yet do not count.
+        """
+        with self._lock:
+            self._unpark(time.time())
+            known = [
+                remaining
+                for remaining in self._remaining.values()
+                if remaining != UNKNOWN_REMAINING
+            ]
+            if len(known) < len(self._remaining):
+                return max(known + [self.min_rate_limit + 1])
+            return max(known)
+
+    def exhausted(self) -> bool:
+        """
+        Returns True if every token in the pool is currently parked.
+        """
+        with self._lock:
+            self._unpark(time.time())
+            return len(self._parked_until) == len(self.tokens)
+
+
+def default_pool(min_rate_limit: int = 0, resource: str = CORE_RESOURCE) -> TokenPool:
+    """
+    Returns the pool over the tokens configured in the environment (see load_tokens) for the given
+    minimum rate limit and resource. The pool is created on first use and shared by all later
+    callers, so that the rate limits it has learned about and the tokens it has parked carry over
+    from one request to the next.
+    """
+    key = (min_rate_limit, resource)
+    with _default_pools_lock:
+        if key not in _default_pools:
+            _default_pools[key] = TokenPool(load_tokens(), min_rate_limit, resource)
+        return _default_pools[key]
+
+
+def authorization_headers(token: Optional[str]) -> Dict[str, str]:
+    """
+    Returns the headers which authenticate a request with the given token.
+    """
+    if token is None:
+        return {}
+    return {"Authorization": f"token {token}"}
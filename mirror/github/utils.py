@@ -5,27 +5,45 @@ from pathlib import Path
 import time
 
 import click
-import requests
-
-REMAINING_RATELIMIT_HEADER = "X-RateLimit-Remaining"
-X_RATELIMIT_RESET = "X-RateLimit-Reset"
 
+from . import client
+from .tokens import (
+    REMAINING_RATELIMIT_HEADER,
+    authorization_headers,
+    default_pool,
+)
 
-def request_with_limit(url, headers, min_rate_limit):
 
-    while True:
+def request_with_limit(url, headers, min_rate_limit, pool=None, params=None):
+    """
+    GET the given url with the token from the pool that has the most remaining rate limit.
 
-        response = requests.get(url, headers=headers)
+    Tokens that reach min_rate_limit are parked until their reset time. If GitHub rejects the
+    request because the rate limit of the chosen token is used up, it is retried with another
+    token (waiting for a reset only if every token in the pool is exhausted).
 
-        rate_limit_raw = response.headers.get(REMAINING_RATELIMIT_HEADER)
+    Without a pool, the shared pool over the tokens configured in the environment is used (see
+    tokens.default_pool).
+    """
+    if pool is None:
+        pool = default_pool(min_rate_limit)
 
-        if rate_limit_raw is not None:
-            current_rate_limit = int(rate_limit_raw)
-            if current_rate_limit <= min_rate_limit:
-                reset_time = response.headers.get(X_RATELIMIT_RESET)
-                time.sleep(abs(int(reset_time) - int(time.time())) + 1)
-            else:
-                break
+    while True:
+        token = pool.acquire()
+        try:
+            response = client.get(
+                url, params=params, headers={**headers, **authorization_headers(token)}
+            )
+        except Exception:
+            pool.release(token)
+            raise
+        pool.update(token, response.headers)
+
+        rate_limited = response.status_code in (403, 429) and (
+            response.headers.get(REMAINING_RATELIMIT_HEADER) == "0"
+        )
+        if not rate_limited:
+            break
     return response
 
 
@@ -59,23 +77,6 @@ def forward_languages_config(input_config, output_dir):
         json.dump(config, config_file)
 
 
-def write_with_size(json_list, file_index, path):
-    """
-    Return current size after writing
-    """
-
-    file_path = os.path.join(path, f"{file_index}.json")
-
-    with open(file_path, "r", encoding="utf8") as file:
-        data = json.load(file)
-
-    with open(file_path, "w", encoding="utf8") as file:
-        data["data"].extend(json_list)
-        json.dump(data, file)
-        size_of_file = file.tell()
-    return size_of_file
-
-
 def flatten_json(y):
     out = {}
 
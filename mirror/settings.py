@@ -9,8 +9,13 @@ MODULE_NAME = "mirror"
 module_version = __version__
 
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_TOKENS = os.environ.get("GITHUB_TOKENS")
+GITHUB_TOKENS_FILE = os.environ.get("GITHUB_TOKENS_FILE")
 CLONE_DIR = os.environ.get("CLONE_DIR")
 MIRROR_CRAWL_INTERVAL_SECONDS = os.environ.get("MIRROR_CRAWL_INTERVAL_SECONDS")
 MIRROR_CRAWL_MIN_RATE_LIMIT = os.environ.get("MIRROR_CRAWL_MIN_RATE_LIMIT")
 MIRROR_CRAWL_BATCH_SIZE = os.environ.get("MIRROR_CRAWL_BATCH_SIZE")
 MIRROR_CRAWL_DIR = os.environ.get("MIRROR_CRAWL_DIR")
+MIRROR_HTTP_TIMEOUT_SECONDS = os.environ.get("MIRROR_HTTP_TIMEOUT_SECONDS")
+MIRROR_HTTP_MAX_RETRIES = os.environ.get("MIRROR_HTTP_MAX_RETRIES")
+MIRROR_HTTP_CACHE_DIR = os.environ.get("MIRROR_HTTP_CACHE_DIR")